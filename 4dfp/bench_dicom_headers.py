@@ -0,0 +1,94 @@
+import argparse
+import multiprocessing
+import os
+import pydicom
+import resource
+import shutil
+import tempfile
+import time
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from dicom_headers import clear_cache, read_header
+
+BENCH_TAGS = ['SeriesNumber', 'SeriesDescription', 'ImageType', 'AcquisitionTime', 'ImageComments']
+
+
+# bytes passed to read() by this process (linux only)
+def bytes_read():
+	with open('/proc/self/io') as f:
+		return next(int(line.split()[1]) for line in f if line.startswith('rchar'))
+
+
+def make_dicoms(dest, num_files, matrix):
+	meta = FileMetaDataset()
+	meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4' # MR image storage
+	for i in range(num_files):
+		meta.MediaStorageSOPInstanceUID = generate_uid()
+		path = os.path.join(dest, 'BENCH.MR.HEAD.1.{}.dcm'.format(i+1))
+		ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+		ds.SeriesNumber = 1
+		ds.SeriesDescription = 'bench_setter'
+		ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'MOSAIC']
+		ds.AcquisitionTime = time.strftime('%H%M%S', time.gmtime(i)) + '.000000'
+		ds.ImageComments = 'vnav {}'.format(i)
+		ds.Rows = ds.Columns = matrix
+		ds.BitsAllocated = ds.BitsStored = 16
+		ds.HighBit = 15
+		ds.SamplesPerPixel = 1
+		ds.PixelRepresentation = 0
+		ds.PhotometricInterpretation = 'MONOCHROME2'
+		ds.PixelData = os.urandom(matrix * matrix * 2)
+		ds.save_as(path)
+
+
+def full_read(paths):
+	return [ pydicom.dcmread(path) for path in paths ]
+
+
+def header_read(paths):
+	clear_cache()
+	return [ read_header(path, BENCH_TAGS) for path in paths ]
+
+
+# run one mode in its own process so peak RSS is not shared between modes
+def measure(func, paths, queue):
+	start_bytes, start_time = bytes_read(), time.perf_counter()
+	datasets = func(paths)
+	comments = [ ds.ImageComments for ds in datasets ]
+	elapsed = time.perf_counter() - start_time
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on linux
+	queue.put((elapsed, bytes_read() - start_bytes, peak_rss, len(comments)))
+
+
+def run(label, func, paths, repeats):
+	results = []
+	for _ in range(repeats):
+		queue = multiprocessing.Queue()
+		proc = multiprocessing.Process(target=measure, args=(func, paths, queue))
+		proc.start()
+		results.append(queue.get())
+		proc.join()
+	elapsed, read, peak_rss, _ = min(results)
+	print('{: <8} {:10.1f} files/s  {:8.1f} KB read/file  {:8.1f} MB peak RSS'.format(label, len(paths) / elapsed, read / len(paths) / 1e3, peak_rss / 1e3))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='compare full pydicom reads against tag-selective header reads on synthetic dicoms')
+	parser.add_argument('--files', type=int, default=500)
+	parser.add_argument('--matrix', type=int, default=512, help='rows/columns of the (16-bit) pixel data')
+	parser.add_argument('--repeats', type=int, default=3)
+	args = parser.parse_args()
+
+	dest = tempfile.mkdtemp(prefix='bench_headers_')
+	try:
+		make_dicoms(dest, args.files, args.matrix)
+		paths = sorted(os.path.join(dest, f) for f in os.listdir(dest))
+		print('{} files, {:.1f} KB each'.format(len(paths), os.path.getsize(paths[0]) / 1e3))
+
+		run('full', full_read, paths, args.repeats)
+		run('header', header_read, paths, args.repeats)
+	finally:
+		shutil.rmtree(dest)
@@ -0,0 +1,46 @@
+import os
+import pydicom
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_CACHED = 4096 # parsed headers kept per process (they only hold the requested tags, so this is small)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# read only the requested tags (keywords or tag numbers) of a dicom, never the pixel data
+#   tags=None reads the whole header; private tags need their private creator, e.g. 0x00190010 for Siemens (0019,10xx)
+#   results are reused within a run as long as the file is unchanged and the cached read covered the requested tags
+def read_header(path, tags=None):
+	key = os.path.abspath(path)
+	stat = os.stat(path)
+	signature = (stat.st_mtime_ns, stat.st_size)
+
+	with _cache_lock:
+		cached = _cache.get(key)
+		if cached and cached[0] == signature and (cached[1] is None or (tags is not None and set(tags) <= cached[1])):
+			_cache.move_to_end(key)
+			return cached[2]
+
+	ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=list(tags) if tags is not None else None)
+	with _cache_lock:
+		_cache[key] = (signature, set(tags) if tags is not None else None, ds)
+		if len(_cache) > MAX_CACHED:
+			_cache.popitem(last=False)
+	return ds
+
+
+# read_header over many files, overlapping the reads (useful on NFS); returned in the order of paths
+def read_headers(paths, tags=None, jobs=1):
+	if jobs == 1:
+		return [ read_header(path, tags) for path in paths ]
+	with ThreadPoolExecutor(max_workers=jobs) as executor:
+		return list(executor.map(lambda path: read_header(path, tags), paths))
+
+
+def clear_cache():
+	with _cache_lock:
+		_cache.clear()
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import pydicom
+import re
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+from dicom_headers import read_header
+from pydicom.errors import InvalidDicomError
+
+INDEX_FILE = '.dicom_index.sqlite'
+INDEX_TAGS = ['SeriesNumber', 'SeriesDescription', 'ImageType', 'AcquisitionTime']
+MAX_DEPTH = 3 # deepest dicom layout is <dir>/<scan>/DICOM/*.dcm
+READ_JOBS = 8 # header reads are dominated by (NFS) latency, so overlap them
+
+scan_number_pattern = '(?:\w*\.){3}(\d+)\..*'
+sorted_dir_pattern = re.compile('study(\d+)$')
+
+_indexes = {}
+os.register_at_fork(after_in_child=_indexes.clear) # forked workers (e.g. params processes) open their own connections
+
+
+# classify a dicom path (relative to the session directory) into the layouts find_dicoms knows about:
+#   sorted (study<N>/*.dcm), flat (*/*.dcm), nested (*/<scan>/DICOM/*.dcm) and header-only (headers/<scan>/*.dcm, see cnda/header_store.py)
+#   returns (layout, scan number) or None if the file is not in one of them
+def classify(relpath):
+	parts = relpath.split(os.sep)
+	if len(parts) == 2:
+		sorted_match = sorted_dir_pattern.match(parts[0])
+		if sorted_match:
+			return 'sorted', sorted_match.group(1)
+		scan_match = re.search(scan_number_pattern, relpath)
+		return 'flat', (str(int(scan_match.group(1))) if scan_match else None)
+	elif len(parts) == 3 and parts[0] == 'headers':
+		return 'headers', parts[1]
+	elif len(parts) == 4 and parts[2] == 'DICOM':
+		return 'nested', parts[1]
+	return None
+
+
+def read_index_header(path):
+	try:
+		ds = read_header(path, INDEX_TAGS)
+	except (InvalidDicomError, OSError) as e:
+		print('Unable to read dicom header:', path, e)
+		return None
+	image_type = ds.get('ImageType', [])
+	return (int(ds.SeriesNumber) if 'SeriesNumber' in ds else None, ds.get('SeriesDescription'),
+		'\\'.join(image_type) if isinstance(image_type, (list, pydicom.multival.MultiValue)) else str(image_type), ds.get('AcquisitionTime'))
+
+
+# per-session index of dicom headers (scan number, series description, ImageType, acquisition time, path, mtime)
+#   stored in <session>/.dicom_index.sqlite; a directory is only re-listed (and its new/changed files re-read) when its mtime changes
+class DicomIndex:
+	def __init__(self, inpath='.'):
+		self.inpath = inpath
+		self.conn = sqlite3.connect(os.path.join(inpath, INDEX_FILE), check_same_thread=False) # may be refreshed from a study_setup stage thread
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT)')
+			self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, layout TEXT, scan TEXT, series_number INTEGER, series_desc TEXT, image_type TEXT, acq_time TEXT, mtime REAL)')
+
+	def _remove_dir(self, reldir):
+		prefix = os.path.join(reldir, '')
+		self.conn.execute('DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?', (reldir, len(prefix), prefix))
+		self.conn.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?', (reldir, len(prefix), prefix))
+
+	# re-list reldir, re-reading headers of new/changed files (sorted study links reuse the row of the file they point to)
+	def _index_dir(self, reldir, entries):
+		stored = dict(self.conn.execute('SELECT path, mtime FROM files WHERE dir = ?', (reldir,)))
+		current = {}
+		for entry in entries:
+			if not entry.name.endswith('.dcm') or not entry.is_file():
+				continue
+			relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+			if classify(relpath):
+				current[relpath] = entry.stat().st_mtime
+
+		for relpath in set(stored) - set(current):
+			self.conn.execute('DELETE FROM files WHERE path = ?', (relpath,))
+
+		changed = [ relpath for relpath, mtime in current.items() if stored.get(relpath) != mtime ]
+		to_read = []
+		for relpath in changed:
+			target = os.path.relpath(os.path.realpath(os.path.join(self.inpath, relpath)), os.path.realpath(self.inpath))
+			row = self.conn.execute('SELECT series_number, series_desc, image_type, acq_time FROM files WHERE path = ?', (target,)).fetchone() if target != relpath else None
+			if row:
+				self._store(relpath, reldir, row, current[relpath])
+			else:
+				to_read.append(relpath)
+
+		with ThreadPoolExecutor(max_workers=READ_JOBS) as executor:
+			headers = executor.map(read_index_header, [ os.path.join(self.inpath, relpath) for relpath in to_read ])
+			for relpath, header in zip(to_read, headers):
+				if header:
+					self._store(relpath, reldir, header, current[relpath])
+
+	def _store(self, relpath, reldir, header, mtime):
+		layout, scan = classify(relpath)
+		if scan is None:
+			scan = str(header[0])
+		self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (relpath, reldir, layout, scan) + tuple(header) + (mtime,))
+
+	def _refresh_dir(self, reldir, depth):
+		try:
+			mtime = os.stat(os.path.join(self.inpath, reldir)).st_mtime
+		except FileNotFoundError:
+			if reldir: # a missing session dir leaves the index as it is (removing '' would drop every row)
+				self._remove_dir(reldir)
+			return
+
+		row = self.conn.execute('SELECT mtime, subdirs FROM dirs WHERE path = ?', (reldir,)).fetchone()
+		if row and row[0] == mtime:
+			subdirs = json.loads(row[1])
+		else:
+			with os.scandir(os.path.join(self.inpath, reldir)) as it:
+				entries = list(it)
+			subdirs = sorted(e.name for e in entries if e.is_dir() and not e.name.startswith('.')) if depth < MAX_DEPTH else []
+			if depth > 0:
+				self._index_dir(reldir, entries)
+			if row:
+				for subdir in set(json.loads(row[1])) - set(subdirs):
+					self._remove_dir(os.path.join(reldir, subdir))
+			self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (reldir, mtime, json.dumps(subdirs)))
+
+		for subdir in subdirs:
+			self._refresh_dir(os.path.join(reldir, subdir) if reldir else subdir, depth + 1)
+
+	# bring the index up to date with the directory tree (unchanged directories cost one stat each)
+	def refresh(self):
+		with self.conn:
+			self._refresh_dir('', 0)
+		return self
+
+	def find(self, layout, scan_number='*'):
+		query = 'SELECT path FROM files WHERE layout = ?'
+		args = [layout]
+		if scan_number != '*':
+			query += ' AND scan = ?'
+			args.append(str(int(scan_number)) if str(scan_number).isdigit() else str(scan_number))
+		return [ os.path.join(self.inpath, path) for path, in self.conn.execute(query + ' ORDER BY path', args) ]
+
+	# hash of the unsorted dicoms (path, mtime), to tell whether a session's data changed since it was last processed
+	def fingerprint(self):
+		digest = hashlib.sha1()
+		for path, mtime in self.conn.execute('SELECT path, mtime FROM files WHERE layout != \'sorted\' ORDER BY path'):
+			digest.update('{}:{}\n'.format(path, mtime).encode())
+		return digest.hexdigest()
+
+	# first dicom (and its scan number) whose series description matches, preferring unsorted files
+	def find_series(self, series_desc):
+		return self.conn.execute('SELECT path, scan FROM files WHERE series_desc = ? ORDER BY layout = \'sorted\', path LIMIT 1', (series_desc,)).fetchone()
+
+	# one representative dicom per scan: [ (scan, series description, image type, path) ], from the first layout (in find_dicoms order) that has any
+	def scans(self):
+		for layout in ['flat', 'nested', 'headers', 'sorted']:
+			rows = self.conn.execute('SELECT scan, series_desc, image_type, MIN(path) FROM files WHERE layout = ? GROUP BY scan', (layout,)).fetchall()
+			if rows:
+				return sorted(( (scan, desc, image_type, os.path.join(self.inpath, path)) for scan, desc, image_type, path in rows ), key=lambda row: (not row[0].isdigit(), int(row[0]) if row[0].isdigit() else 0, row[0]))
+		return []
+
+	def series_descriptions(self):
+		return { desc for desc, in self.conn.execute('SELECT DISTINCT series_desc FROM files') }
+
+	def image_type(self, scan_number, layouts=('sorted', 'flat', 'nested', 'headers')):
+		for layout in layouts:
+			row = self.conn.execute('SELECT image_type FROM files WHERE layout = ? AND scan = ? LIMIT 1', (layout, str(scan_number))).fetchone()
+			if row:
+				return row[0].split('\\')
+		return None
+
+
+# shared, refreshed index for a session directory (one per process and directory)
+def get_index(inpath='.'):
+	key = os.path.abspath(inpath)
+	if key not in _indexes:
+		_indexes[key] = DicomIndex(key) # absolute, so the cached index still points at the session after a chdir
+	return _indexes[key].refresh()
@@ -0,0 +1,102 @@
+import argparse
+import glob
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from dicom_headers import read_header
+from pydicom.errors import InvalidDicomError
+
+SORT_TAGS = ['SeriesNumber', 'SequenceName', 'SeriesDescription']
+CHUNK_SIZE = 64 # files handed to a worker at a time
+
+
+def read_sort_header(path):
+	try:
+		ds = read_header(path, SORT_TAGS)
+	except (InvalidDicomError, OSError) as e:
+		print('Unable to read dicom header:', path, e)
+		return None
+	if 'SeriesNumber' not in ds:
+		return None
+	return int(ds.SeriesNumber), str(ds.get('SequenceName', 'unknown')), str(ds.get('SeriesDescription', 'unknown'))
+
+
+# all dicoms under dicom_dir, flat (<dir>/*.dcm) or nested (<dir>/<scan>/DICOM/*.dcm)
+def list_dicoms(dicom_dir):
+	dcms = []
+	for root, dirs, files in os.walk(dicom_dir):
+		dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+		dcms.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.dcm'))
+	return dcms
+
+
+# studies file line: <scan number> <sequence name> <series description> <number of images> (same format as dcm_sort)
+def format_study(series_number, sequence_name, series_desc, count):
+	return ' '.join([str(series_number), sequence_name.replace(' ', '_') or 'unknown', series_desc.replace(' ', '_') or 'unknown', str(count)])
+
+
+# remove the studies file(s) and study<N> links of an earlier sort from outdir, so a re-sort does not keep removed/renumbered scans
+#   (files in study<N> that are not links, e.g. from a copying dcm_sort, are left in place)
+def clear_sorted(outdir='.'):
+	for studies_file in glob.glob(os.path.join(outdir, '*.studies.txt')):
+		os.remove(studies_file)
+	for study_dir in glob.glob(os.path.join(outdir, 'study*')):
+		if not re.match(r'study\d+$', os.path.basename(study_dir)) or not os.path.isdir(study_dir) or os.path.islink(study_dir):
+			continue
+		with os.scandir(study_dir) as it:
+			for e in it:
+				if e.is_symlink():
+					os.remove(e.path)
+		if not os.listdir(study_dir):
+			os.rmdir(study_dir)
+
+
+# in-process replacement for dcm_sort / pseudo_dcm_sort.csh: reads SeriesNumber, SequenceName and SeriesDescription
+#   from every dicom across a process pool, writes <dicom_dir>.studies.txt to outdir and (optionally) links files into outdir/study<N>
+#   returns the name of the studies file
+def sort_dicoms(dicom_dir, outdir='.', link=True, jobs=None):
+	dcms = list_dicoms(dicom_dir)
+	if jobs == 1: # e.g. when already running inside a worker of params_setup.gen_params_batch
+		headers = [ read_sort_header(dcm) for dcm in dcms ]
+	else:
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			headers = list(executor.map(read_sort_header, dcms, chunksize=CHUNK_SIZE))
+
+	series = {}
+	for dcm, header in zip(dcms, headers):
+		if header is None:
+			continue
+		series_number, sequence_name, series_desc = header
+		if series_number not in series:
+			series[series_number] = (sequence_name, series_desc, [])
+		series[series_number][2].append(dcm)
+
+	studies_file = os.path.join(outdir, os.path.basename(os.path.abspath(dicom_dir)) + '.studies.txt')
+	with open(studies_file, 'w') as f:
+		for series_number in sorted(series):
+			sequence_name, series_desc, files = series[series_number]
+			f.write(format_study(series_number, sequence_name, series_desc, len(files)) + '\n')
+
+	if link:
+		for series_number, (_, _, files) in series.items():
+			study_dir = os.path.join(outdir, 'study{}'.format(series_number))
+			os.makedirs(study_dir, exist_ok=True)
+			for dcm in files:
+				link_name = os.path.join(study_dir, os.path.basename(dcm))
+				if not os.path.lexists(link_name):
+					os.symlink(os.path.relpath(os.path.abspath(dcm), os.path.abspath(study_dir)), link_name)
+
+	print('Sorted {} dicoms into {} series ({})'.format(sum(len(s[2]) for s in series.values()), len(series), studies_file))
+	return studies_file
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='sort dicoms by series (in-process replacement for dcm_sort / pseudo_dcm_sort.csh)')
+	parser.add_argument('dicom_dir', help='directory containing dicoms (flat or <scan>/DICOM/ nested)')
+	parser.add_argument('-o', '--outdir', default='.', help='where to write the studies file and study<N> directories (default = current directory)')
+	parser.add_argument('--no_link', action='store_true', help='only write the studies file (no study<N> links)')
+	parser.add_argument('-j', '--jobs', type=int, help='number of worker processes (default = number of cores)')
+	args = parser.parse_args()
+
+	sort_dicoms(args.dicom_dir, args.outdir, not args.no_link, args.jobs)
@@ -1,56 +1,59 @@
 import argparse
+import csv
 import glob
 import math
+import numpy as np
 import os
-import pydicom
 import re
 
+from collections import Counter
+from dicom_headers import read_header
+from dicom_index import get_index
 from params_common import write_file
 from sys import exit, stderr
 
-scan_number_pattern = '(?:\w*\.){3}(\d+)\..*'
-sorted_path_template = 'study{}/*.dcm'
-flat_path_template = '*/*.dcm'
-nested_path_template = '*/{}/DICOM/*.dcm'
+# header tags used by instructions() (the Siemens private creator is needed to decode the (0019,10xx) tags)
+INSTRUCTION_TAGS = ['Rows', 'Columns', 'RepetitionTime', 'EchoTime', 0x00190010, 0x0019100a, 0x00191028, 0x00191029]
+BANDWIDTH_TAG = (0x19,0x1028) # BandwidthPerPixelPhaseEncode (only in EPI headers)
+SLICE_TIMING_TAG = (0x19,0x1029) # MosaicRefAcqTimes
 
+# parameters compared against the study norm in batch mode
+NUMERIC_PARAMS = ['nx', 'ny', 'TR_vol', 'TE_vol', 'dwell', 'MBfac']
+ORDER_PARAMS = ['interleave', 'Siemens_interleave', 'seqstr']
 
+
+# dicom lookups go through the session's header index (see dicom_index.py) rather than globbing the tree each call
 def find_dicoms(scan_number='*', sorted=False, inpath='.'):
+	index = get_index(inpath)
 	if sorted:
-		return glob.glob(os.path.join(inpath, sorted_path_template.format(scan_number)))
+		return index.find('sorted', scan_number)
 	else:
-		flat_files = [ f for f in glob.glob(os.path.join(inpath, flat_path_template)) if not f.startswith('study') ]
-		if scan_number != '*':
-			flat_files = [ f for f in flat_files if int(re.search(scan_number_pattern, dcm).groups(1)) == scan_number ]
-		return flat_files if flat_files else glob.glob(os.path.join(inpath, nested_path_template.format(scan_number)))
+		dicoms = index.find('flat', scan_number) or index.find('nested', scan_number)
+		return dicoms if dicoms else index.find('headers', scan_number)
 
 
-def get_header_data(series_desc):
-	series_map = {}
+def get_header_data(series_desc, inpath='.', tags=None):
+	index = get_index(inpath)
 	studies_file = glob.glob('*.studies.txt')
 
-	if not studies_file: # if dicoms are not sorted, search headers to find desired scans
-		for dcm in find_dicoms():
-			scan_number = re.search(scan_number_pattern, dcm).groups(1)
-
-			if scan_number in series_map:
-				continue
-		
-			ds = pydicom.read_file(dcm)
-			if ds.SeriesDescription == series_desc:
-				return ds
-			else:
-				series_map[scan_number] = ds.SeriesDescription
+	if not studies_file: # if dicoms are not sorted, look the series up in the index
+		match = index.find_series(series_desc)
+		if match:
+			return read_header(match[0], tags)
+		series_descs = index.series_descriptions()
 	else: # otherwise, grab a matching scan number from studies file
+		series_map = {}
 		with open(studies_file[0]) as f:
 			for line in f:
 				scan_num, _, desc, _ = line.split(' ')
 				if series_desc in line:
-					dcm = find_dicoms(scan_num, True)[0]
-					return pydicom.read_file(dcm)
+					dcm = (index.find('sorted', scan_num) or find_dicoms(scan_num, inpath=inpath))[0] # fall back to unsorted / header-only dicoms
+					return read_header(dcm, tags)
 				series_map[scan_num] = desc
+		series_descs = set(series_map.values())
 
 	stderr.write('No matching dicoms found!')
-	print(set(series_map.values()))
+	print(series_descs)
 	exit(1)
 
 
@@ -58,9 +61,29 @@ def calc_unpack_dim(img_dim, num_imgs):
 	return img_dim / math.ceil(math.sqrt(num_imgs))
 
 
-def instructions(series_desc, output_file=None):
-	ds = get_header_data(series_desc)
+# slice acquisition order parameters from the mosaic slice times (ms) of one volume
+def slice_order_params(slice_timing):
+	slice_timing = np.atleast_1d(np.asarray(slice_timing, dtype=float))
+	params = {}
+
+	MBfac = int(np.count_nonzero(slice_timing == 0)) # get number of bands
+	params['MBfac'] = MBfac
+
+	band_timing = slice_timing[:len(slice_timing) // MBfac]
+	slice_order = np.argsort(band_timing, kind='stable') + 1 # ties keep slice order, same as sorting (time, slice) pairs
+	first_half = slice_order[:len(slice_order) // 2]
+
+	if np.array_equal(slice_order, np.arange(1, len(slice_order)+1)): # check if sequential
+		params['interleave'] = '-S'
+	elif np.all(first_half % 2 == 0): # check for Siemen's interleave (starts with evens if even number of slices)
+		params['Siemens_interleave'] = 1
+	elif not np.all(first_half % 2 != 0): # if not regular interleave (starts with odd slices and is enabled if no other interleave param is set), supply slice ordering
+		params['seqstr'] = ','.join(map(str, slice_order))
+
+	return params
 
+
+def compute_instructions(ds):
 	instructions = {
 		'nx': calc_unpack_dim(ds.Rows, ds[0x19,0x100a].value),
 		'ny': calc_unpack_dim(ds.Columns, ds[0x19,0x100a].value),
@@ -70,37 +93,118 @@ def instructions(series_desc, output_file=None):
 	}
 
 	# assume BOLD if 'BandwidthPerPixelPhaseEncode' in DICOM header
-	bandwidth_tag = (0x19,0x1028)
-	if bandwidth_tag:
-		instructions['dwell'] = 1000 / (float(ds[bandwidth_tag].value) * instructions['nx'] )
-
-		slice_timing = ds[0x19,0x1029].value
+	if BANDWIDTH_TAG in ds:
+		instructions['dwell'] = 1000 / (float(ds[BANDWIDTH_TAG].value) * instructions['nx'] )
 
 		# slice_timing only exists for multiband
-		if slice_timing:
-			MBfac = slice_timing.count(0) # get number of bands
-			instructions['MBfac'] = MBfac
+		if SLICE_TIMING_TAG in ds and ds[SLICE_TIMING_TAG].value:
+			instructions.update(slice_order_params(ds[SLICE_TIMING_TAG].value))
 
-			num_slices = len(slice_timing)
-			slice_time_tuples = sorted([ (time, slc) for slc, time in enumerate(slice_timing[:num_slices // MBfac]) ])
-			slice_order = [ tup[1]+1 for tup in slice_time_tuples ]
+	return instructions
 
-			if slice_order == range(1, num_slices+1): # check if sequential
-				instructions['interleave'] = '-S'
-			elif all(slc % 2 == 0 for slc in slice_order[:len(slice_order) // 2]): # check for Siemen's interleave (starts with evens if even number of slices)
-				instructions['Siemens_interleave'] = 1
-			elif not all(slc % 2 != 0 for slc in slice_order[:len(slice_order) // 2]): # if not regular interleave (starts with odd slices and is enabled if no other interleave param is set), supply slice ordering
-				instructions['seqstr'] = ','.join(map(str,slice_order))
+
+def instructions(series_desc, output_file=None):
+	ds = get_header_data(series_desc, tags=INSTRUCTION_TAGS)
 
 	if not output_file:
 		output_file = '../{}.params'.format(os.path.basename(os.path.abspath('..')))
-	write_file(output_file, instructions)
+	write_file(output_file, compute_instructions(ds))
+
+
+# instructions for every BOLD (EPI mosaic) scan in a session, from one pass over its header index
+#   returns [ (scan number, series description, instructions) ]
+def scan_instructions(inpath='.', series_pattern=None):
+	results = []
+	for scan, series_desc, image_type, dcm in get_index(inpath).scans():
+		if 'MOSAIC' not in (image_type or '').split('\\') or (series_pattern and not re.search(series_pattern, series_desc or '')):
+			continue
+		ds = read_header(dcm, INSTRUCTION_TAGS)
+		if BANDWIDTH_TAG not in ds:
+			continue
+		results.append((scan, series_desc, compute_instructions(ds)))
+	return results
+
+
+# most common value of each column (ignoring nan)
+def column_modes(values):
+	modes = np.full(values.shape[1], np.nan)
+	for i, column in enumerate(values.T):
+		column = column[~np.isnan(column)]
+		if column.size:
+			uniq, counts = np.unique(column, return_counts=True)
+			modes[i] = uniq[np.argmax(counts)]
+	return modes
+
+
+# for each row, the parameters that differ from the norm (most common value) of its series description across the study
+def flag_outliers(rows):
+	flags = [ [] for _ in rows ]
+	by_series = {}
+	for i, (_, _, series_desc, _) in enumerate(rows):
+		by_series.setdefault(series_desc, []).append(i)
+
+	for series_desc, idx in by_series.items():
+		values = np.array([ [ rows[i][3].get(param, np.nan) for param in NUMERIC_PARAMS ] for i in idx ], dtype=float)
+		differs = ~np.isclose(values, column_modes(values), rtol=1e-3, equal_nan=True)
+
+		orders = [ tuple(rows[i][3].get(param) for param in ORDER_PARAMS) for i in idx ]
+		norm_order = Counter(orders).most_common(1)[0][0] # ties go to the order seen first, so flags do not depend on hash order
+
+		for row_differs, order, i in zip(differs, orders, idx):
+			flags[i] = [ param for param, d in zip(NUMERIC_PARAMS, row_differs) if d ] + (['slice_order'] if order != norm_order else [])
+
+	return flags
+
+
+# write instructions for all BOLD series of one or more sessions at once (<session>/<series_desc>_instructions.params,
+#   taken from the first scan of each series) plus a per-scan summary with parameters that differ from the study norm
+def batch_instructions(sessions=['.'], series_pattern=None, summary_file='instructions_summary.csv'):
+	rows = [ (session, scan, series_desc, params) for session in sessions for scan, series_desc, params in scan_instructions(session, series_pattern) ]
+	if not rows:
+		stderr.write('No BOLD series found!\n')
+		return []
+
+	flags = flag_outliers(rows)
+
+	# each session's <series_desc>_instructions.params comes from its scan closest to the study norm (fewest flagged
+	#   parameters, then first by scan order), so a deviating scan is not the one written out
+	representative = {}
+	for (session, scan, series_desc, params), flagged in zip(rows, flags):
+		key = (session, series_desc)
+		if key not in representative or len(flagged) < len(representative[key][1]):
+			representative[key] = (params, flagged)
+	for (session, series_desc), (params, flagged) in representative.items():
+		if flagged:
+			print('Warning: no {} scan in {} matches the study norm, instructions written from the closest one'.format(series_desc, session))
+		write_file(os.path.join(session, '{}_instructions.params'.format(series_desc)), params)
+
+	flagged_rows = [ (row, flagged) for row, flagged in zip(rows, flags) if flagged ]
+	if flagged_rows:
+		print('Scans differing from the study norm:')
+		for (session, scan, series_desc, _), flagged in flagged_rows:
+			print('\t{} scan {} ({}): {}'.format(session, scan, series_desc, ', '.join(flagged)))
+
+	with open(summary_file, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['session', 'scan', 'series_desc'] + NUMERIC_PARAMS + ORDER_PARAMS + ['differs_from_norm'])
+		for (session, scan, series_desc, params), flagged in zip(rows, flags):
+			writer.writerow([os.path.basename(os.path.abspath(session)), scan, series_desc] + [ params.get(param) for param in NUMERIC_PARAMS + ORDER_PARAMS ] + [';'.join(flagged)])
+
+	return rows
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Generate scan-specific instructions variables for cross_bold (to be run from subject dir)')
-	parser.add_argument('epi_series_desc', help='series description for scan')
+	parser.add_argument('epi_series_desc', nargs='?', help='series description for scan (not needed with --all/--sessions)')
 	parser.add_argument('-o', '--output_file', help='output file name (default = ../<parent_dir>.params)')
+	parser.add_argument('-a', '--all', action='store_true', help='write instructions for every BOLD series in the current session (<series_desc>_instructions.params)')
+	parser.add_argument('--sessions', nargs='+', help='like --all, but for each of these session directories (run from study dir); series that differ from the study norm are flagged')
+	parser.add_argument('--series_pattern', help='only include BOLD series whose description matches this regex (with --all/--sessions)')
 	args = parser.parse_args()
 
-	instructions(args.epi_series_desc, args.output_file)
+	if args.all or args.sessions:
+		batch_instructions(args.sessions if args.sessions else ['.'], args.series_pattern)
+	elif args.epi_series_desc:
+		instructions(args.epi_series_desc, args.output_file)
+	else:
+		parser.error('epi_series_desc is required unless --all or --sessions is used')
@@ -2,24 +2,20 @@ import argparse
 import fnmatch
 import glob
 import json
-import pydicom
+import os
 import re
 
+from concurrent.futures import ProcessPoolExecutor
+from dicom_index import classify, get_index
+from dicom_sort import clear_sorted, sort_dicoms
 from instructions import find_dicoms
 from params_common import write_file
+from study_index import get_study_index
 from os import chdir, getcwd, listdir
 from os.path import dirname, islink, join
-from subprocess import call
 
 
-def sort_dicoms(dicom_dir, is_flat):
-	if is_flat:
-		call(['dcm_sort', dicom_dir])
-	else:
-		call(['pseudo_dcm_sort.csh', dicom_dir, '-s'])
-
-
-# helper function to read the output of (pseudo_)dcm_sort to map scan numbers to descriptions
+# helper function to read the output of dicom_sort (same format as (pseudo_)dcm_sort) to map scan numbers to descriptions
 def read_studies_file(studies_file):
 	scans = []
 	with open(studies_file, 'r') as f:
@@ -31,35 +27,57 @@ def read_studies_file(studies_file):
 	return sorted(scans)
 
 
+# study config compiled once: all series_desc_mapping patterns are combined into a single regex (first matching key wins, as with
+#   the per-key fnmatch loop) and the irun label of every mapped series is resolved up front
+class SeriesMatcher:
+	def __init__(self, config):
+		self.scan_mappings = { k: v for k,v in config['series_desc_mapping'].items() if v != '' }
+		self.keys = list(self.scan_mappings.keys())
+		self.group_names = [ 'series_key{}'.format(i) for i in range(len(self.keys)) ]
+		self.pattern = re.compile('|'.join('(?P<{}>{})'.format(name, fnmatch.translate(key)) for name, key in zip(self.group_names, self.keys)))
+
+		self.irun_mapping = config['irun']
+		self.irun_labels = {}
+		for key in self.keys:
+			irun_matches = [ re.match(item, key) for item in self.irun_mapping.keys() ]
+			if any(irun_matches):
+				self.irun_labels[key] = self.irun_mapping[next(item for item in irun_matches if item is not None).group(0)]
+
+	# config key matching series_desc (None if not in config)
+	def match(self, series_desc):
+		match = self.pattern.match(series_desc) if self.keys else None
+		if not match:
+			return None
+		return next(key for name, key in zip(self.group_names, self.keys) if match.group(name) is not None)
+
+
 # generate params file from studies file mappings
-def gen_params_file(patid, study_config, sort=False, inpath='.', duplicates=None, day1_patid=None, outfile=None):
-	with open(study_config) as config_file:
-			config = json.load(config_file)
+#   config/matcher can be passed in to avoid re-reading and re-compiling the study config for every session (see gen_params_batch)
+def gen_params_file(patid, study_config, sort=False, inpath='.', duplicates=None, day1_patid=None, outfile=None, jobs=None, config=None, matcher=None):
+	if not config:
+		with open(study_config) as config_file:
+				config = json.load(config_file)
+	if not matcher:
+		matcher = SeriesMatcher(config)
 
 	studies_file = next(iter(glob.glob('*.studies.txt')), 0)
+	dcms = find_dicoms(inpath=inpath) if sort or not studies_file else []
+	header_only = bool(dcms) and classify(os.path.relpath(dcms[0], os.path.abspath(inpath)))[0] == 'headers' # only the header store (one file per scan, no pixel data)
+
+	# with sort, an earlier sort is redone so new/changed scans are picked up (if there are unsorted dicoms to sort from)
+	if sort and studies_file and dcms and not header_only:
+		clear_sorted()
+		studies_file = 0
 
 	if not studies_file:
-		dcms = find_dicoms(inpath=inpath)
 		if not dcms:
 			print('Error: no dicoms found under current directory. If your dicoms are stored elsewhere, try the --inpath flag')
 			exit(-1)
 
-		dcm_paths = { os.path.dirname(dcm) for dcm in dcms }
-		if len(dcm_paths) == 1:
-			flat = True
-			dcm_dir = next(dcm_paths)
-		else:
-			flat = False
-			split_dcm_paths = { s.split(os.sep) for s in dcm_paths }
-			dcm_dir_parts = []
-			for i in range(min(len(s) for s in split_dcm_paths)):
-				elems = { p[i] for p in split_dcm_paths }
-				if len(elems) == 1:
-					dcm_dir_parts.append(next(elem))
-				break
-			dcm_dir = os.path.join(dcm_dir_parts)
-		sort_dicoms(dcm_dir, flat)
-		studies_file = os.path.basename(dcm_dir) + '.studies.txt'
+		dcm_dir = os.path.commonpath([ os.path.dirname(dcm) for dcm in dcms ]) # index paths are absolute
+		if header_only: # scan numbers/descriptions are all params needs, but there is nothing to link into study<N> and image counts are per header
+			print('Warning: only header-store dicoms found; writing the studies file without study<N> links (re-run with --sort once the full dicoms are downloaded)')
+		studies_file = sort_dicoms(dcm_dir, link=not header_only, jobs=jobs)
 
 	scans = read_studies_file(studies_file)
 	params = {
@@ -67,39 +85,35 @@ def gen_params_file(patid, study_config, sort=False, inpath='.', duplicates=None
 		'irun': []
 	}
 
-	scan_mappings = { k: v for k,v in config['series_desc_mapping'].items() if v != '' }
-	print(scan_mappings)
-	for val in scan_mappings.values():
+	print(matcher.scan_mappings)
+	for val in matcher.scan_mappings.values():
 		params[val] = []
 
-	irun_mapping = config['irun']
-	irun_series = list(irun_mapping.keys()) # get all series that contribute to fstd/irun
-	label_counts = { k:0 for k in list(irun_mapping.values()) } # setup map to keep track of how many of each label seen so far
+	sorted_index, dicom_index = get_index(), get_index(inpath) # sorted study dirs live in the current directory
+
+	label_counts = { k:0 for k in list(matcher.irun_mapping.values()) } # setup map to keep track of how many of each label seen so far
 
 	for scan in scans:
 		scan_number = str(scan[0])
 		series_desc = scan[1]
 
-		series_desc_matches = [ key for key in scan_mappings.keys() if fnmatch.fnmatch(series_desc, key) ]
-		if not series_desc_matches:
+		series_key = matcher.match(series_desc)
+		if not series_key:
 			print('Scan type not found in config:', series_desc)
 			continue
-		series_key = series_desc_matches[0]
 
 		# remove unwanted duplicate (non-functional) images if present
-		if duplicates and series_key not in irun_mapping.keys():
-			img_type = pydicom.read_file(find_dicoms(scan_number, True)[0]).ImageType
+		if duplicates and series_key not in matcher.irun_mapping.keys():
+			img_type = sorted_index.image_type(scan_number, ['sorted']) or dicom_index.image_type(scan_number, ['flat', 'nested', 'headers']) # fall back to unsorted / header-only dicoms
 			if  ('NORM' in img_type and duplicates == 'orig') or ('NORM' not in img_type and duplicates == 'norm'):
 				continue
 
-		var = scan_mappings[series_key] # variable is value of series description in config
+		var = matcher.scan_mappings[series_key] # variable is value of series description in config
 		params[var].append(scan_number) # set variable to the current scan number
 
 		# add appropriate numbered label to irun list
-		irun_matches = [ re.match(item, series_key) for item in irun_series ]
-		if any(irun_matches):
-			irun_match = next(item for item in irun_matches if item is not None).group(0)
-			label = irun_mapping[irun_match]
+		if series_key in matcher.irun_labels:
+			label = matcher.irun_labels[series_key]
 			label_counts[label] += 1
 			params['irun'].append(label + str(label_counts[label]))
 
@@ -110,7 +124,10 @@ def gen_params_file(patid, study_config, sort=False, inpath='.', duplicates=None
 	# set up cross day parameters if day1_patid specified (i.e. if current session is not subject's first
 	if day1_patid:
 		params['day1_patid'] = day1_patid
-		params['day1_path'] = glob.glob(join(dirname(study_config), '**', day1_patid, 'atlas'), recursive=True)[0]
+		params['day1_path'] = get_study_index(dirname(os.path.abspath(study_config))).atlas_path(day1_patid) # study root is where the config lives
+		if not params['day1_path']:
+			print('Error: no atlas directory found for day1 patid', day1_patid)
+			exit(-1)
 	
 	params_file = outfile if outfile else '.'.join([patid, 'params'])
 	write_file(params_file, params)
@@ -118,15 +135,68 @@ def gen_params_file(patid, study_config, sort=False, inpath='.', duplicates=None
 	return
 
 
+# worker for gen_params_batch: runs gen_params_file from inside the session directory
+#   returns (session, None) on success or (session, error message) so one bad session does not abort the batch
+def gen_session_params(session, study_config, config, matcher, duplicates=None, day1_patid=None, sort_jobs=1):
+	try:
+		chdir(session)
+		gen_params_file(os.path.basename(session), study_config, True, duplicates=duplicates, day1_patid=day1_patid, jobs=sort_jobs, config=config, matcher=matcher)
+		return session, None
+	except (Exception, SystemExit) as e: # gen_params_file exits if a session has no dicoms
+		return session, '{}: {}'.format(type(e).__name__, e) if isinstance(e, Exception) else 'exited with status {}'.format(e.code)
+
+
+# session directories under study_dir without a params file yet
+def discover_sessions(study_dir='.'):
+	return sorted( d for d in listdir(study_dir) if os.path.isdir(join(study_dir, d)) and not d.startswith('.') and not os.path.exists(join(study_dir, d, d + '.params')) )
+
+
+# study naming convention: sessions are <patid>_s<N>, and every session after the first is registered to <patid>_s1
+def default_day1_patid(session):
+	return '{}_s1'.format(session.split('_')[0]) if not session.endswith('s1') else None
+
+
+# generate params files for many sessions in parallel worker processes, compiling the study config only once
+#   day1_patids maps session -> day1 patid (None for a first session); sessions not in it get default_day1_patid
+#   returns { session: error message or None }
+def gen_params_batch(study_config, sessions=None, duplicates=None, day1_patids={}, jobs=None):
+	study_config = os.path.abspath(study_config)
+	with open(study_config) as config_file:
+		config = json.load(config_file)
+	matcher = SeriesMatcher(config)
+
+	if sessions is None:
+		sessions = discover_sessions()
+	get_study_index(dirname(study_config)) # bring the study index up to date once, before workers look up day1 atlases in it
+
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		futures = [ executor.submit(gen_session_params, os.path.abspath(session), study_config, config, matcher, duplicates, day1_patids.get(session, default_day1_patid(os.path.basename(os.path.abspath(session))))) for session in sessions ]
+		results = dict( future.result() for future in futures )
+
+	errors = { session: error for session, error in results.items() if error }
+	for session, error in errors.items():
+		print('Error generating params for {}:\n{}'.format(os.path.basename(session), error))
+	print('Generated params for {}/{} sessions'.format(len(results) - len(errors), len(results)))
+
+	return { os.path.basename(session): error for session, error in results.items() }
+
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
-	parser.add_argument('patid')
+	parser.add_argument('patid', nargs='?', help='session to generate params for (not needed with --batch)')
 	parser.add_argument('study_config', help='json config file containing series desc to params variable mapping (see study_config_template.json)')
-	parser.add_argument('-s', '--sort', action='store_true', help='run dcm_sort as part of setup process')
-	parser.add_argument('--inpath', help='path to subject raw data directory')
+	parser.add_argument('-s', '--sort', action='store_true', help='sort dicoms as part of setup process, replacing any earlier sort (studies file / study<N> links)')
+	parser.add_argument('--inpath', default='.', help='path to subject raw data directory')
 	parser.add_argument('-d', '--duplicates', choices=['orig', 'norm'], help='if there are duplicate scans, which Image Type to use (defualt use all)')
 	parser.add_argument('--day1_patid', help='patient directory for first session (if patid is not patient\'s first session)')
 	parser.add_argument('--outfile', help='name for output file')
+	parser.add_argument('-j', '--jobs', type=int, help='number of processes used to sort dicoms, or sessions processed at once with --batch (default = number of cores)')
+	parser.add_argument('-b', '--batch', nargs='*', metavar='session', help='generate params for these session directories (run from study dir; default = all sessions without a params file); sessions other than <patid>_s1 use <patid>_s1 as day1_patid')
 	args = parser.parse_args()
 
-	gen_params_file(args.patid, args.study_config, args.sort, args.inpath, args.duplicates, args.day1_patid, args.outfile)
+	if args.batch is not None:
+		gen_params_batch(args.study_config, args.batch if args.batch else None, args.duplicates, jobs=args.jobs)
+	elif args.patid:
+		gen_params_file(args.patid, args.study_config, args.sort, args.inpath, args.duplicates, args.day1_patid, args.outfile, args.jobs)
+	else:
+		parser.error('patid is required unless --batch is used')
@@ -0,0 +1,114 @@
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import threading
+
+INDEX_FILE = '.study_index.sqlite'
+MAX_DEPTH = 4 # how far below the study root to look for session directories
+FS_SUBDIRS = { 'surf', 'mri', 'scripts' } # created by recon-all as soon as a subject is started
+
+bold_dir_pattern = re.compile('bold\d+$')
+
+_indexes = {}
+os.register_at_fork(after_in_child=_indexes.clear) # forked workers (e.g. params processes) open their own connections
+
+
+# study-level index of patid -> processing directories (4dfp atlas and bold runs, FreeSurfer subject)
+#   stored in <root>/.study_index.sqlite; like the dicom index, directories are only re-listed when their mtime changes
+#   and the walk stops at session directories, so keeping it up to date costs one stat per directory
+class StudyIndex:
+	def __init__(self, root='.'):
+		self.root = root
+		self.lock = threading.Lock() # one index per process may be used from several threads (e.g. study_setup stages)
+		self.conn = sqlite3.connect(os.path.join(root, INDEX_FILE), timeout=30, check_same_thread=False) # file is shared by parallel params workers
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT)')
+			self.conn.execute('CREATE TABLE IF NOT EXISTS sessions (path TEXT PRIMARY KEY, patid TEXT, atlas TEXT, bold TEXT, fs INTEGER)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS sessions_patid ON sessions (patid)')
+
+	# drop reldir (or, with keep_self, only what is below it) from the index
+	def _remove_dir(self, reldir, keep_self=False):
+		prefix = os.path.join(reldir, '')
+		for table in ['sessions', 'dirs']:
+			self.conn.execute('DELETE FROM {} WHERE substr(path, 1, ?) = ?'.format(table) + ('' if keep_self else ' OR path = ?'), (len(prefix), prefix) + (() if keep_self else (reldir,)))
+
+	# returns True if reldir holds processing output (and so is not descended into)
+	def _index_session(self, reldir, subdirs):
+		atlas = 'atlas' in subdirs
+		bold = sorted(d for d in subdirs if bold_dir_pattern.match(d))
+		fs = FS_SUBDIRS.issubset(subdirs)
+		if not (atlas or bold or fs):
+			self.conn.execute('DELETE FROM sessions WHERE path = ?', (reldir,))
+			return False
+
+		self.conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)', (reldir, os.path.basename(reldir), os.path.join(reldir, 'atlas') if atlas else None,
+			json.dumps([ os.path.join(reldir, d) for d in bold ]), int(fs)))
+		self._remove_dir(reldir, keep_self=True)
+		return True
+
+	def _refresh_dir(self, reldir, depth):
+		try:
+			mtime = os.stat(os.path.join(self.root, reldir)).st_mtime
+		except FileNotFoundError:
+			self._remove_dir(reldir)
+			return
+
+		row = self.conn.execute('SELECT mtime, subdirs FROM dirs WHERE path = ?', (reldir,)).fetchone()
+		if row and row[0] == mtime:
+			subdirs = json.loads(row[1])
+		else:
+			with os.scandir(os.path.join(self.root, reldir)) as it:
+				subdirs = sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir())
+			if reldir and self._index_session(reldir, subdirs):
+				subdirs = []
+			elif row:
+				for subdir in set(json.loads(row[1])) - set(subdirs):
+					self._remove_dir(os.path.join(reldir, subdir))
+			if depth == MAX_DEPTH:
+				subdirs = []
+			self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (reldir, mtime, json.dumps(subdirs)))
+
+		for subdir in subdirs:
+			self._refresh_dir(os.path.join(reldir, subdir) if reldir else subdir, depth + 1)
+
+	def refresh(self):
+		with self.lock, self.conn:
+			self._refresh_dir('', 0)
+		return self
+
+	def _query(self, sql, args=()):
+		with self.lock:
+			return self.conn.execute(sql, args).fetchall()
+
+	def _rows(self, patid, where=''):
+		return self._query('SELECT path, atlas, bold, fs FROM sessions WHERE patid = ?' + where + ' ORDER BY path', (patid,))
+
+	# { 'path', 'atlas', 'bold', 'fs' } for every indexed directory named patid
+	def lookup(self, patid):
+		return [ { 'path': os.path.join(self.root, path), 'atlas': os.path.join(self.root, atlas) if atlas else None, 'bold': [ os.path.join(self.root, b) for b in json.loads(bold) ], 'fs': bool(fs) }
+			for path, atlas, bold, fs in self._rows(patid) ]
+
+	def atlas_path(self, patid):
+		rows = self._rows(patid, ' AND atlas IS NOT NULL')
+		return os.path.join(self.root, rows[0][1]) if rows else None
+
+	def bold_dirs(self, patid):
+		return [ os.path.join(self.root, b) for row in self._rows(patid) for b in json.loads(row[2]) ]
+
+	def fs_subject(self, patid):
+		rows = self._rows(patid, ' AND fs')
+		return os.path.join(self.root, rows[0][0]) if rows else None
+
+	# FreeSurfer subject directories whose patid matches a unix-style pattern
+	def fs_subjects(self, pattern='*'):
+		return [ os.path.join(self.root, path) for path, patid in self._query('SELECT path, patid FROM sessions WHERE fs ORDER BY path') if fnmatch.fnmatch(patid, pattern) ]
+
+
+# shared, refreshed index for a study root (one per process and directory)
+def get_study_index(root='.'):
+	key = os.path.abspath(root)
+	if key not in _indexes:
+		_indexes[key] = StudyIndex(key)
+	return _indexes[key].refresh()
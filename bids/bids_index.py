@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_FILE = '.bids_index.sqlite'
+READ_JOBS = 16 # sidecar reads are mostly NFS latency, so many can be in flight at once
+SIDECAR_FIELDS = ['SeriesNumber', 'SeriesDescription', 'AcquisitionTime']
+COLUMNS = ['path', 'sub', 'ses', 'datatype', 'suffix', 'run', 'ext', 'mtime', 'series_number', 'series_desc', 'acq_time']
+
+_indexes = {}
+
+
+def _subdirs(path, prefix=''):
+	try:
+		with os.scandir(path) as it:
+			return sorted(e.name for e in it if e.name.startswith(prefix) and not e.name.startswith('.') and e.is_dir())
+	except FileNotFoundError:
+		return []
+
+
+# bids entities of a file name, e.g. sub-01_ses-1_task-rest_run-02_bold.nii.gz -> ({ 'sub': '01', 'ses': '1', 'task': 'rest', 'run': '02' }, 'bold', '.nii.gz')
+def parse_filename(filename):
+	stem, dot, ext = filename.partition('.')
+	parts = stem.split('_')
+	entities = dict(part.split('-', 1) for part in parts[:-1] if '-' in part)
+	return entities, parts[-1], dot + ext
+
+
+def read_sidecar(path):
+	try:
+		with open(path) as f:
+			sidecar = json.load(f)
+	except (OSError, ValueError):
+		sidecar = {}
+	return [ sidecar.get(field) for field in SIDECAR_FIELDS ]
+
+
+# per-file index of a bids dataset (sub, ses, datatype, suffix, run, extension, and SeriesNumber/SeriesDescription/AcquisitionTime of sidecars)
+#   stored in <bids_dir>/.bids_index.sqlite; a refresh lists the subject/session/datatype folders and stats the sidecars,
+#   and only sidecars that are new or changed (by mtime) are read
+class BidsIndex:
+	def __init__(self, bids_dir):
+		self.bids_dir = bids_dir
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(os.path.join(bids_dir, INDEX_FILE), timeout=30, check_same_thread=False)
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, sub TEXT, ses TEXT, datatype TEXT, suffix TEXT, run TEXT, ext TEXT, mtime REAL, series_number INTEGER, series_desc TEXT, acq_time TEXT)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS files_sub ON files (sub, ses)')
+
+	# relpath -> (sub, ses, datatype, mtime) of the files in sub-*/[ses-*/][<datatype>/] (mtime only for sidecars)
+	def _walk(self, sub_dirs):
+		found = {}
+		for sub_dir in sub_dirs:
+			sub = sub_dir[len('sub-'):]
+			for ses_dir in [ '' ] + _subdirs(os.path.join(self.bids_dir, sub_dir), 'ses-'):
+				ses = ses_dir[len('ses-'):] if ses_dir else None
+				parent = os.path.join(sub_dir, ses_dir) if ses_dir else sub_dir
+				for datatype in [ None ] + [ d for d in _subdirs(os.path.join(self.bids_dir, parent)) if not d.startswith('ses-') ]:
+					reldir = os.path.join(parent, datatype) if datatype else parent
+					try:
+						with os.scandir(os.path.join(self.bids_dir, reldir)) as it:
+							for e in it:
+								if not e.name.startswith('.') and e.is_file():
+									found[os.path.join(reldir, e.name)] = (sub, ses, datatype, e.stat().st_mtime if e.name.endswith('.json') else None)
+					except FileNotFoundError:
+						continue
+		return found
+
+	# bring the whole index (or one subject's files) up to date
+	def refresh(self, sub=None, jobs=READ_JOBS):
+		sub_dirs = [ 'sub-' + sub ] if sub else _subdirs(self.bids_dir, 'sub-')
+		found = self._walk(d for d in sub_dirs if os.path.isdir(os.path.join(self.bids_dir, d)))
+		with self.lock:
+			cached = dict(self.conn.execute('SELECT path, mtime FROM files' + (' WHERE sub = ?' if sub else ''), (sub,) if sub else ()))
+
+		changed = [ path for path, (_, _, _, mtime) in found.items() if path not in cached or cached[path] != mtime ]
+		sidecars = [ path for path in changed if path.endswith('.json') ]
+		with ThreadPoolExecutor(max_workers=jobs) as executor:
+			sidecar_fields = dict(zip(sidecars, executor.map(read_sidecar, [ os.path.join(self.bids_dir, path) for path in sidecars ])))
+
+		rows = []
+		for path in changed:
+			sub_label, ses, datatype, mtime = found[path]
+			entities, suffix, ext = parse_filename(os.path.basename(path))
+			rows.append([path, sub_label, ses, datatype, suffix, entities.get('run'), ext, mtime] + sidecar_fields.get(path, [ None ] * len(SIDECAR_FIELDS)))
+
+		with self.lock, self.conn:
+			self.conn.executemany('INSERT OR REPLACE INTO files VALUES ({})'.format(', '.join('?' * len(COLUMNS))), rows)
+			self.conn.executemany('DELETE FROM files WHERE path = ?', [ (path,) for path in cached if path not in found ])
+		return self
+
+	# files matching all filters (column=value, or column=[ values ]; None matches anything), as dicts with full paths
+	def query(self, **filters):
+		where, args = [], []
+		for column, value in filters.items():
+			if column not in COLUMNS:
+				raise ValueError('Unknown bids index column: {}'.format(column))
+			if value is None:
+				continue
+			values = value if isinstance(value, (list, tuple, set)) else [ value ]
+			where.append('{} IN ({})'.format(column, ', '.join('?' * len(values))))
+			args += list(values)
+
+		with self.lock:
+			rows = self.conn.execute('SELECT {} FROM files{} ORDER BY path'.format(', '.join(COLUMNS), ' WHERE ' + ' AND '.join(where) if where else ''), args).fetchall()
+		return [ dict(zip(COLUMNS, row), path=os.path.join(self.bids_dir, row[0])) for row in rows ]
+
+	def has_session(self, sub, ses=None):
+		return bool(self.query(sub=sub, ses=ses))
+
+	def subjects(self):
+		with self.lock:
+			return [ sub for sub, in self.conn.execute('SELECT DISTINCT sub FROM files ORDER BY sub') ]
+
+
+# shared index for a bids dir (one per process and directory), refreshed when first used;
+#   tools that change a subject's files afterwards should call refresh(sub)
+def get_bids_index(bids_dir):
+	key = os.path.abspath(bids_dir)
+	if key not in _indexes:
+		_indexes[key] = BidsIndex(key).refresh()
+	return _indexes[key]
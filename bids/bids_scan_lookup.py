@@ -1,32 +1,28 @@
 import argparse
 import csv
-import json
 import os
 import re
 
-from glob import glob
+from bids_index import get_bids_index
 
+SIDECAR_DATATYPES = [ 'anat', 'func' ]
 
-def gen_bids_scan_lut(bids_dir):
-	results = [['sub', 'ses', 'bids_run', 'modality', 'filename', 'series_num']]
 
-	# check for both single-session and multi-session folders for sidecars (more efficient than recursive glob)
-	sidecars = glob(os.path.join(bids_dir, 'sub-*', 'anat', '*.json')) + glob(os.path.join(bids_dir, 'sub-*', 'ses-*', 'anat', '*.json')) \
-		+ glob(os.path.join(bids_dir, 'sub-*', 'func', '*.json')) + glob(os.path.join(bids_dir, 'sub-*', 'ses-*', 'func', '*.json'))
-	for sidecar in sidecars:
-		print('Processing', sidecar, '...')
-		filename = os.path.basename(sidecar)
-		sub, ses, run, mod  = re.search('sub-(\w+)(?:_ses-(\w+))?(?:_\w+-\w+)?(?:_run-(\d{2}))?_(\w+).json', filename).groups()
-		run = run if run else 1
+def lut_row(sidecar):
+	filename = os.path.basename(sidecar['path'])
+	sub, ses, run, mod  = re.search('sub-(\w+)(?:_ses-(\w+))?(?:_\w+-\w+)?(?:_run-(\d{2}))?_(\w+).json', filename).groups()
+	run = run if run else 1
+
+	return [sub, ses, run, mod, os.path.splitext(filename)[0], sidecar['series_number']]
 
-		with open(sidecar) as f:
-			series_num = json.load(f)['SeriesNumber']
 
-		results.append([sub, ses, run, mod, os.path.splitext(filename)[0], series_num])
+# anat/func sidecars and their series numbers come from the bids index (see bids_index.py), so only new/changed sidecars are read
+def gen_bids_scan_lut(bids_dir):
+	results = [ lut_row(sidecar) for sidecar in get_bids_index(bids_dir).query(datatype=SIDECAR_DATATYPES, ext='.json') ]
 
 	outfile =  os.path.join(bids_dir, 'bids_scan_num_lookup.csv')
 	with open(outfile, 'w', newline='') as f:
-		csv.writer(f).writerows(results)
+		csv.writer(f).writerows([['sub', 'ses', 'bids_run', 'modality', 'filename', 'series_num']] + results)
 
 
 if __name__ == '__main__':
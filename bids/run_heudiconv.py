@@ -6,6 +6,7 @@ import stat
 
 from glob import glob
 from subprocess import call
+from bids_index import get_bids_index
 from bids_scan_lookup import gen_bids_scan_lut
 
 GENERIC_CONVERTALL_PATH = '/net/zfs-black/BLACK/black/git/utils/bids/config/generic_convertall.py'
@@ -14,7 +15,8 @@ BASE_CMD = 'docker run --rm -it --user={uid}:{gid}'.format(uid=os.getuid(), gid=
 
 def run_heudiconv(dcm_dir, sub, ses, convertall=GENERIC_CONVERTALL_PATH, heuristic=None,
 					bids_dir=os.getcwd(), redo=False, mriqc=False):
-	if not redo and os.path.exists(os.path.join(bids_dir, 'sub-' + sub, 'ses-' + ses)):
+	index = get_bids_index(bids_dir)
+	if not redo and index.has_session(sub, ses):
 		print('subject has already been converted:', sub)
 		return
 
@@ -35,7 +37,7 @@ def run_heudiconv(dcm_dir, sub, ses, convertall=GENERIC_CONVERTALL_PATH, heurist
 
 	# converted files are read only, so change json file permissions afterwards
 	mode = (stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH)
-	for f in glob(os.path.join(bids_dir, 'sub-' + sub, '**', '*.json'), recursive=True):
+	for f in [ row['path'] for row in index.refresh(sub).query(sub=sub, ext='.json') ]:
 		print(f, mode)
 		os.chmod(f, mode)
 
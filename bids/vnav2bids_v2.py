@@ -5,7 +5,6 @@ import glob
 import json
 import numpy as np
 import os
-import pydicom
 import re
 import requests
 import shutil
@@ -13,13 +12,14 @@ import sys
 import tempfile
 import vnav
 
-from cnda_common import get_all_sessions
+from bids_index import get_bids_index
+from cnda_common import cache_stats, enable_cache, extract_stream, get_all_sessions, get_scan_info, CndaClient, CACHE_FILE, DOWNLOAD_PARAMS, LONG_FORM_TEMPLATE
+from header_store import header_dir, prefetch_headers
+from dicom_headers import read_header, read_headers
 from getpass import getpass
 from itertools import count, groupby
-from zipfile import ZipFile
+from zipfile import BadZipFile
 
-SCAN_REQUEST_TEMPLATE = 'https://cnda.wustl.edu/data/projects/{}/subjects/{}/experiments/{}/scans'
-DOWNLOAD_REQUEST = 'https://cnda.wustl.edu/data/projects/{}/subjects/{}/experiments/{}/scans/{}/resources/{}/files?format=zip&structure=simplified'
 
 modality_search = re.compile('_(T\dw)')
 
@@ -37,25 +37,24 @@ def extract_vnav_scores(scan_info):
 		print('Error: Unable to parse vnav data')
 		return { score_type: None for score_type in ['mean_rms', 'mean_max', 'rms_scores', 'max_scores'] }
 
-def download(sess, url, outfile):
-	response = sess.get(url, stream=True)
+def download(sess, url, dest):
+	response = sess.get(url, params=DOWNLOAD_PARAMS, stream=True)
 	print(url, response.status_code)
-	with open(outfile, 'wb') as f:
-		shutil.copyfileobj(response.raw, f)
 
 	try:
-		ZipFile(outfile).extractall(os.path.dirname(outfile))
-		os.remove(outfile)
-	except:
-		print('Empty zip: ', outfile)
+		if not extract_stream(response.raw, dest):
+			print('Empty zip: ', url)
+	except BadZipFile:
+		print('Invalid zip: ', url)
 
 
-def vnav2bids(sess, project_id, config, bids_dir, session_label, session_map, scratch_dir=None, redo=False):
+def vnav2bids(sess, project_id, config, bids_dir, session_label, session_map, scratch_dir=None, redo=False, headers_only=False):
 	work_dir = scratch_dir if scratch_dir else bids_dir
 
 	subject_id, _, session = session_label.partition('_') # assumes only one underscore seprates sub from session (but does support multi-underscore sessions)
 
-	if not os.path.exists(os.path.join(bids_dir, 'sub-' + subject_id)):
+	index = get_bids_index(bids_dir)
+	if not index.has_session(subject_id):
 		print('\tSubject folder does not exist in bids dir. Skipping...')
 		return None
 
@@ -66,9 +65,7 @@ def vnav2bids(sess, project_id, config, bids_dir, session_label, session_map, sc
 			return None
 		session = 'ses-' + session_map[session_match[0]]
 
-	session_scans_url = SCAN_REQUEST_TEMPLATE.format(project_id, subject_id, session_label)
-	response = sess.get(session_scans_url, params={'format': 'json'})
-	scan_map = { scan['ID']: scan['series_description'] for scan in response.json()['ResultSet']['Result'] }
+	scan_map = dict(get_scan_info(sess, project_id, subject_id, session_label, sess.host))
 
 	anat_series = { item['series_description'] for item in config['bidsmap']['anat'] }
 	if config['series_desc_regex']:
@@ -79,7 +76,7 @@ def vnav2bids(sess, project_id, config, bids_dir, session_label, session_map, sc
 
 	results = {}
 	for series_desc in anat_series:
-		anat_sidecars = glob.glob(os.path.join(bids_dir, 'sub-' + subject_id, '**', 'anat', '*.json'), recursive=True)
+		anat_sidecars = [ row['path'] for row in index.query(sub=subject_id, datatype='anat', ext='.json', series_desc=series_desc) ]
 		if session:
 			anat_sidecars = [ f for f in anat_sidecars if re.search(session + os.path.sep, os.path.dirname(f), flags=re.IGNORECASE) ]
 
@@ -108,20 +105,23 @@ def vnav2bids(sess, project_id, config, bids_dir, session_label, session_map, sc
 			continue
 
 		# map navigator sequence acquisition time to the sorted quaternion list
-		session_zipfile = os.path.join(work_dir, session_label + '.zip')
 		nav_scan_ids = [ id for id, desc in scan_map.items() if re.match(series_desc + '\w+', desc) ]
 		if not nav_scan_ids:
 			print('\tNo vnav scans found!')
 			continue
-		download_nav_dcm_url = DOWNLOAD_REQUEST.format(project_id, subject_id, session_label, ','.join(nav_scan_ids), 'DICOM')
-		download(sess, download_nav_dcm_url, session_zipfile)
+		# with headers_only, setter headers go to a persistent header store (<work_dir>/<session>/headers) instead of a full download
+		base_url = LONG_FORM_TEMPLATE.format(sess.host, project_id, subject_id, session_label)
+		if headers_only:
+			prefetch_headers(sess, base_url, session_label, ','.join(nav_scan_ids), 'DICOM', work_dir, all_files=True, host=sess.host)
+		else:
+			download(sess, '{}/scans/{}/resources/DICOM/files'.format(base_url, ','.join(nav_scan_ids)), work_dir)
 
 		nav_scan_info = {}
 		for scan_id in nav_scan_ids:
-			dcms = glob.glob(os.path.join(work_dir, session_label, 'scans', scan_id, 'DICOM', '*'))
-			dcm_datasets = [ pydicom.read_file(dcm) for dcm in dcms ]
-			if 'MOSAIC' not in dcm_datasets[0].ImageType: # correct setter image will have mosiac in scan type
+			dcms = glob.glob(os.path.join(header_dir(os.path.join(work_dir, session_label), scan_id), '*') if headers_only else os.path.join(work_dir, session_label, 'scans', scan_id, 'DICOM', '*'))
+			if 'MOSAIC' not in read_header(dcms[0], ['ImageType']).ImageType: # correct setter image will have mosiac in scan type
 				continue
+			dcm_datasets = read_headers(dcms, ['AcquisitionTime', 'ImageComments'])
 			scan_info = sorted([ (float(ds.AcquisitionTime), ds.ImageComments if 'ImageComments' in ds else None) for ds in dcm_datasets ])
 			nav_scan_info[scan_info[0][0]] = [ tup[1] for tup in scan_info ] # key = acquistion time, value = list of motion strings
 
@@ -144,7 +144,7 @@ def vnav2bids(sess, project_id, config, bids_dir, session_label, session_map, sc
 
 	# clean up after all downloads/uploads are complete
 	temp_folder = os.path.join(work_dir, session_label)
-	if os.path.exists(temp_folder):
+	if os.path.exists(temp_folder) and not headers_only:
 		shutil.rmtree(temp_folder)
 
 	return results
@@ -158,13 +158,17 @@ if __name__ == '__main__':
 	parser.add_argument('--subjects_file')
 	parser.add_argument('--session_label', help='CNDA session label')
 	parser.add_argument('--scratch_dir')
+	parser.add_argument('--headers_only', action='store_true', help='fetch only setter DICOM headers (kept in <scratch_dir>/<session>/headers for later runs)')
 	parser.add_argument('--redo', action='store_true')
+	parser.add_argument('--cache', nargs='?', const=CACHE_FILE, help='cache CNDA metadata in sqlite file (default {}) so repeat runs only query new/changed sessions'.format(CACHE_FILE))
 	parser.add_argument('--')
 	args = parser.parse_args()
 
+	if args.cache:
+		enable_cache(args.cache)
+
 	auth_info = (args.user, getpass())
-	sess = requests.Session()
-	sess.auth = auth_info
+	sess = CndaClient(auth_info)
 
 	with open(args.config_file) as f:
 		config = json.load(f)
@@ -185,7 +189,7 @@ if __name__ == '__main__':
 			continue
 
 		print(session_label)
-		vnav_scores = vnav2bids(sess, args.project_id, config, args.bids_dir, session_label, session_map, args.scratch_dir, args.redo)
+		vnav_scores = vnav2bids(sess, args.project_id, config, args.bids_dir, session_label, session_map, args.scratch_dir, args.redo, args.headers_only)
 
 		if not vnav_scores:
 			continue
@@ -199,3 +203,6 @@ if __name__ == '__main__':
 				writer = csv.writer(f)
 				writer.writerow([session_label, tup[0], tup[1], 'rms'] + scores['rms_scores'] if scores['rms_scores'] else [])
 				writer.writerow([session_label, tup[0], tup[1], 'max'] + scores['max_scores'] if scores['max_scores'] else [])
+
+	print(cache_stats())
+	print(sess.metrics.report())
@@ -0,0 +1,94 @@
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from shutil import copyfileobj
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from cnda_common import extract_stream
+
+
+# write-only wrapper so ZipFile emits data descriptors the way a streamed CNDA/XNAT archive does
+class _UnseekableWriter(io.RawIOBase):
+	def __init__(self, fileobj):
+		self.fileobj = fileobj
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		return self.fileobj.write(data)
+
+
+# read-only wrapper that hands out data in network-sized pieces (like response.raw)
+class _StreamReader(io.RawIOBase):
+	def __init__(self, data, chunk_size=64 * 1024):
+		self.fileobj = io.BytesIO(data)
+		self.chunk_size = chunk_size
+
+	def readable(self):
+		return True
+
+	def read(self, n=-1):
+		return self.fileobj.read(self.chunk_size if n is None or n < 0 else min(n, self.chunk_size))
+
+
+# bytes passed to write() by this process (linux only)
+def bytes_written():
+	with open('/proc/self/io') as f:
+		return next(int(line.split()[1]) for line in f if line.startswith('wchar'))
+
+
+def make_session_zip(num_scans, files_per_scan, file_size, compression):
+	buf = io.BytesIO()
+	with ZipFile(_UnseekableWriter(buf), 'w', compression) as zf:
+		for scan in range(1, num_scans+1):
+			for i in range(files_per_scan):
+				header = os.urandom(file_size // 4) # incompressible part to mimic pixel noise
+				zf.writestr('BENCH_s1/scans/{}/DICOM/BENCH_s1.MR.head.{}.{}.dcm'.format(scan, scan, i+1), header + bytes(file_size - len(header)))
+	return buf.getvalue()
+
+
+def legacy_extract(data, dest):
+	zip_file = os.path.join(dest, 'BENCH_s1.zip')
+	with open(zip_file, 'wb') as f:
+		copyfileobj(_StreamReader(data), f)
+	dl = ZipFile(zip_file)
+	dl.extractall(dest)
+	dl.close()
+	os.remove(zip_file)
+
+
+def stream_extract(data, dest):
+	extract_stream(_StreamReader(data), dest)
+
+
+def run(label, func, data, repeats):
+	times, written = [], []
+	for _ in range(repeats):
+		dest = tempfile.mkdtemp(prefix='bench_extract_')
+		start_bytes, start_time = bytes_written(), time.perf_counter()
+		func(data, dest)
+		times.append(time.perf_counter() - start_time)
+		written.append(bytes_written() - start_bytes)
+		shutil.rmtree(dest)
+	print('{: <8} best {:8.3f} s  {:10.1f} MB written'.format(label, min(times), min(written) / 1e6))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='compare zip-to-disk + extractall against streaming extraction of a synthetic session')
+	parser.add_argument('--scans', type=int, default=10)
+	parser.add_argument('--files', type=int, default=200, help='files per scan')
+	parser.add_argument('--file_size', type=int, default=256 * 1024, help='bytes per file')
+	parser.add_argument('--stored', action='store_true', help='use stored (uncompressed) members, which forces the spooling fallback')
+	parser.add_argument('--repeats', type=int, default=3)
+	args = parser.parse_args()
+
+	data = make_session_zip(args.scans, args.files, args.file_size, ZIP_STORED if args.stored else ZIP_DEFLATED)
+	print('archive: {:.1f} MB, {} members'.format(len(data) / 1e6, args.scans * args.files))
+
+	run('legacy', legacy_extract, data, args.repeats)
+	run('stream', stream_extract, data, args.repeats)
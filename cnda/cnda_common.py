@@ -1,9 +1,23 @@
+import bisect
+import hashlib
 import json
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import requests
+import zlib
 
-from zipfile import ZipFile
-from os import remove
-from os.path import exists
-from shutil import copyfileobj
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from zipfile import BadZipFile, ZipFile
+from os.path import exists, getsize, join
+from urllib.parse import urlencode, urlparse
 
 
 HOST = 'https://cnda.wustl.edu'
@@ -12,6 +26,7 @@ LONG_FORM_TEMPLATE = '{}/data/projects/{}/subjects/{}/experiments/{}'
 SHORT_FORM_TEMPLATE = '{}/data/experiments/{}'
 
 ALL_SESSION_REQUEST_TEMPLATE = '{}/data/projects/{}/experiments'
+SUBJECT_SESSION_REQUEST_TEMPLATE = '{}/data/projects/{}/subjects/{}/experiments'
 DOWNLOAD_LONG_FORM_REQUEST_TEMPLATE = '{}/data/projects/{}/subjects/{}experiments/{}/scans/{}/resources/{}/files'
 DOWNLOAD_REQUEST_TEMPLATE = '{}/data/projects/{}/experiments/{}/scans/{}/resources/{}/files'
 SCAN_RESOURCES_REQUEST_TEMPLATE = '{}/data/experiments/{}/scans/{}/resources'
@@ -20,23 +35,547 @@ SCAN_REQUEST_TEMPLATE = '{}/data/projects/{}/subjects/{}/experiments/{}/scans'
 JSON_FORMAT = {'format': 'json'}
 DOWNLOAD_PARAMS = {'format': 'zip', 'structure': 'simplified'}
 
+CHUNK_SIZE = 1024 * 1024
+TRANSFER_CHUNK_SIZE = 64 * 1024 # kept small so an interrupted transfer loses little of what was already received
+
+LOCAL_HEADER_SIG = b'PK\x03\x04'
+DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+END_OF_ENTRIES_SIGS = [ b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06' ] # central directory / end of central directory records
+LOCAL_HEADER_FORMAT = '<HHHHHIIIHH'
+ZIP64_EXTRA_ID = 0x0001
+STORED, DEFLATED = 0, 8
+
+JOURNAL_FILE = '.download_journal'
+RANGE_NOT_SATISFIABLE = 416
+PARTIAL_CONTENT = 206
+scan_id_search = re.compile('/scans/([^/]+)/resources/')
+scan_dir_search = re.compile('(?:^|/)scans/([^/]+)/')
+
+MANIFEST_TEMPLATE = '{}_manifest.json'
+TAG_LOOKUP_JOBS = 8
+
+CACHE_FILE = '.cnda_cache.sqlite'
+CACHE_TTL = 7 * 24 * 60 * 60 # seconds
+LISTING_TTL = 0 # project session listings drive per-session invalidation, so they are re-fetched every run by default
+SESSION_COLUMNS = 'ID,label,insert_date,last_modified' # last_modified is the session version for the metadata cache
+
+POOL_SIZE = 16
+RATE_LIMIT = 20 # requests per second
+REQUEST_TIMEOUT = (10, 300) # seconds (connect, read)
+REQUEST_RETRIES = 3
+RETRY_STATUS = [ 429, 500, 502, 503, 504 ]
+LATENCY_BUCKETS = [ 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ] # seconds
+REST_COLLECTIONS = [ 'projects', 'subjects', 'experiments', 'scans', 'resources', 'files' ]
+
+
+# thread-safe token bucket: allows bursts of up to capacity requests, then rate requests per second
+class TokenBucket:
+	def __init__(self, rate=RATE_LIMIT, capacity=None):
+		self.rate = rate
+		self.capacity = capacity if capacity else rate
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+# helper function to collapse ids in a REST url so requests are grouped per endpoint (e.g. /data/experiments/*/scans/*/resources)
+def endpoint_key(url):
+	parts = urlparse(url).path.split('/')
+	return '/'.join('*' if i > 0 and parts[i-1] in REST_COLLECTIONS else part for i, part in enumerate(parts))
+
+
+# per-endpoint request counts, latency histograms (time to response headers) and bytes received
+class RequestMetrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.endpoints = {}
+
+	def _endpoint(self, endpoint):
+		return self.endpoints.setdefault(endpoint, { 'requests': 0, 'bytes': 0, 'seconds': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1) })
+
+	def record(self, endpoint, latency, nbytes=0):
+		with self.lock:
+			stats = self._endpoint(endpoint)
+			stats['requests'] += 1
+			stats['seconds'] += latency
+			stats['bytes'] += nbytes
+			stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+	def add_bytes(self, endpoint, nbytes):
+		with self.lock:
+			self._endpoint(endpoint)['bytes'] += nbytes
+
+	def report(self):
+		labels = [ '<={}s'.format(b) for b in LATENCY_BUCKETS ] + [ '>{}s'.format(LATENCY_BUCKETS[-1]) ]
+		lines = [ 'CNDA requests by endpoint:' ]
+		with self.lock:
+			for endpoint, stats in sorted(self.endpoints.items()):
+				histogram = ' '.join('{}:{}'.format(label, count) for label, count in zip(labels, stats['histogram']) if count)
+				lines.append('  {} requests={} mean={:.3f}s bytes={} [{}]'.format(endpoint, stats['requests'], stats['seconds'] / max(stats['requests'], 1), stats['bytes'], histogram))
+		return '\n'.join(lines)
+
+
+# shared session for all CNDA access: sized connection pool, retries, default timeouts, rate limiting and request metrics
+class CndaClient(requests.Session):
+	def __init__(self, auth=None, host=HOST, pool_size=POOL_SIZE, rate=RATE_LIMIT, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES):
+		super().__init__()
+		self.auth = auth
+		self.host = host
+		self.timeout = timeout
+		self.rate_limiter = TokenBucket(rate)
+		self.metrics = RequestMetrics()
+
+		retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=RETRY_STATUS, allowed_methods=['GET', 'HEAD'], raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+		self.mount('https://', adapter)
+		self.mount('http://', adapter)
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		endpoint = endpoint_key(url)
+
+		self.rate_limiter.acquire()
+		start = time.perf_counter()
+		response = super().request(method, url, **kwargs)
+		latency = time.perf_counter() - start
+
+		if kwargs.get('stream'): # body hasn't been read yet, so count bytes as they are consumed
+			self.metrics.record(endpoint, latency)
+			raw_read = response.raw.read
+			def counting_read(*args, **read_kwargs):
+				data = raw_read(*args, **read_kwargs)
+				self.metrics.add_bytes(endpoint, len(data))
+				return data
+			response.raw.read = counting_read
+		else:
+			self.metrics.record(endpoint, latency, len(response.content))
+		return response
+
+
 def get_result_array(response):
 	return response.json()['ResultSet']['Result']
 
 
+# opt-in persistent cache for CNDA metadata (JSON results keyed by url + params)
+#   every entry expires after ttl seconds; entries tied to a session are also dropped as soon as the session's
+#   last_modified (or insert_date, if not reported) changes in a project listing
+class MetadataCache:
+	def __init__(self, db_file=CACHE_FILE, ttl=CACHE_TTL, listing_ttl=LISTING_TTL):
+		self.ttl = ttl
+		self.listing_ttl = listing_ttl
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(db_file, check_same_thread=False)
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, session TEXT, fetched REAL, result TEXT)')
+			self.conn.execute('CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, version TEXT)')
+
+	def get(self, key, session=None, ttl=None):
+		ttl = self.ttl if ttl is None else ttl
+		with self.lock:
+			row = self.conn.execute('SELECT fetched, result FROM responses WHERE key = ?', (key,)).fetchone()
+			if row and time.time() - row[0] < ttl: # session versions need not change when a session only gains scans/resources, so they only invalidate early
+				self.hits += 1
+				return json.loads(row[1])
+			self.misses += 1
+			return None
+
+	def put(self, key, result, session=None):
+		with self.lock, self.conn:
+			self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, session, time.time(), json.dumps(result)))
+
+	# record each session's version (by ID and label), dropping cached results for sessions that are new or changed
+	def update_sessions(self, sessions):
+		with self.lock, self.conn:
+			versions = dict(self.conn.execute('SELECT session, version FROM sessions'))
+			for session in sessions:
+				version = session.get('last_modified') or session['insert_date']
+				for name in (session['ID'], session['label']):
+					if versions.get(name) == version:
+						continue
+					self.conn.execute('DELETE FROM responses WHERE session = ?', (name,))
+					self.conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?)', (name, version))
+
+	def stats(self):
+		return 'CNDA metadata cache: {} hits, {} misses'.format(self.hits, self.misses)
+
+
+_cache = None
+
+def enable_cache(db_file=CACHE_FILE, ttl=CACHE_TTL, listing_ttl=LISTING_TTL):
+	global _cache
+	_cache = MetadataCache(db_file, ttl, listing_ttl)
+	return _cache
+
+
+def cache_stats():
+	return _cache.stats() if _cache else 'CNDA metadata cache disabled'
+
+
+# GET a ResultSet, going through the metadata cache if it is enabled
+def get_cached_result_array(sess, url, params=JSON_FORMAT, session=None, ttl=None):
+	key = '{}?{}'.format(url, urlencode(sorted(params.items()), doseq=True))
+	if _cache:
+		result = _cache.get(key, session, ttl)
+		if result is not None:
+			return result
+
+	response = sess.get(url, params=params)
+	response.raise_for_status()
+	result = get_result_array(response)
+	if _cache:
+		_cache.put(key, result, session)
+	return result
+
+
+# buffered reader over a non-seekable stream (i.e. a streamed HTTP response body) that allows pushing bytes back
+class _StreamBuffer:
+	def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+		self.fileobj = fileobj
+		self.chunk_size = chunk_size
+		self.buffer = b''
+
+	def read(self, n):
+		while len(self.buffer) < n:
+			chunk = self.fileobj.read(self.chunk_size)
+			if not chunk:
+				break
+			self.buffer += chunk
+		data, self.buffer = self.buffer[:n], self.buffer[n:]
+		return data
+
+	def read_chunk(self, max_size=None):
+		max_size = max_size if max_size else self.chunk_size
+		if not self.buffer:
+			return self.fileobj.read(min(max_size, self.chunk_size))
+		data, self.buffer = self.buffer[:max_size], self.buffer[max_size:]
+		return data
+
+	def unread(self, data):
+		self.buffer = data + self.buffer
+
+
+# helper function to map a zip member name to a path under dest (refuses absolute paths and parent references)
+def _member_path(dest, name):
+	parts = [ p for p in name.replace('\\', '/').split('/') if p not in ('', '.') ]
+	if not parts or '..' in parts:
+		raise BadZipFile('Unsafe member name in zip stream: {}'.format(name))
+	return os.path.join(dest, *parts)
+
+
+def _zip64_sizes(extra, csize, usize):
+	while len(extra) >= 4:
+		header_id, data_size = struct.unpack('<HH', extra[:4])
+		if header_id == ZIP64_EXTRA_ID:
+			data = extra[4:4+data_size]
+			if usize == 0xFFFFFFFF:
+				usize, data = struct.unpack('<Q', data[:8])[0], data[8:]
+			if csize == 0xFFFFFFFF:
+				csize = struct.unpack('<Q', data[:8])[0]
+			return True, csize, usize
+		extra = extra[4+data_size:]
+	return False, csize, usize
+
+
+# helper function to consume the data descriptor following a streamed member and check it against what was extracted
+def _read_data_descriptor(reader, is_zip64, crc, csize, usize):
+	sig = reader.read(4)
+	if sig != DATA_DESCRIPTOR_SIG: # signature is optional
+		reader.unread(sig)
+	fmt = '<IQQ' if is_zip64 else '<III'
+	desc_crc, desc_csize, desc_usize = struct.unpack(fmt, reader.read(struct.calcsize(fmt)))
+	if (desc_crc, desc_csize, desc_usize) != (crc, csize, usize):
+		raise BadZipFile('Data descriptor mismatch in zip stream')
+
+
+# write a single member to outfile as its data arrives; returns (crc, compressed size, uncompressed size)
+def _extract_member(reader, outfile, method, csize, has_descriptor):
+	crc, read_size, written_size = 0, 0, 0
+	decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == DEFLATED else None
+
+	with open(outfile, 'wb') as f:
+		while True:
+			if has_descriptor:
+				if decompressor.eof:
+					break
+				chunk = reader.read_chunk()
+			else:
+				if read_size == csize:
+					break
+				chunk = reader.read_chunk(csize - read_size)
+			if not chunk:
+				raise BadZipFile('Zip stream ended in the middle of a member')
+
+			data = decompressor.decompress(chunk) if decompressor else chunk
+			if decompressor and decompressor.unused_data:
+				reader.unread(decompressor.unused_data)
+				chunk = chunk[:len(chunk) - len(decompressor.unused_data)]
+			read_size += len(chunk)
+
+			f.write(data)
+			crc = zlib.crc32(data, crc)
+			written_size += len(data)
+
+		if decompressor:
+			data = decompressor.flush()
+			f.write(data)
+			crc = zlib.crc32(data, crc)
+			written_size += len(data)
+
+	return crc, read_size, written_size
+
+
+# spool the unread part of the archive (starting with the current local header) and extract the remaining members from it
+#   ZipFile corrects central directory offsets for the missing leading bytes, so only the remainder needs to touch disk
+def _extract_spooled(reader, header_bytes, dest, extracted):
+	with tempfile.TemporaryFile(dir=dest) as spool:
+		spool.write(header_bytes)
+		chunk = reader.read_chunk()
+		while chunk:
+			spool.write(chunk)
+			chunk = reader.read_chunk()
+		spool.seek(0)
+
+		with ZipFile(spool) as zf:
+			for member in zf.infolist():
+				if member.filename in extracted:
+					continue
+				zf.extract(member, dest)
+				if not member.is_dir():
+					extracted.append(member.filename)
+
+
+# move everything under src into dest (merging with existing directories, e.g. a session being topped up)
+def _move_tree(src, dest):
+	for root, dirs, files in os.walk(src):
+		target = os.path.join(dest, os.path.relpath(root, src))
+		os.makedirs(target, exist_ok=True)
+		for f in files:
+			os.replace(os.path.join(root, f), os.path.join(target, f))
+
+
+# extract a zip archive from a non-seekable stream, writing members as the data arrives
+#   falls back to spooling the rest of the archive only when a member cannot be delimited from its local header
+#   (stored with a trailing data descriptor, unsupported compression or encryption)
+#   members are extracted to a hidden directory under dest and only moved into place once the whole archive is read,
+#   so a failed transfer leaves no partial session behind; any corrupt/truncated stream raises BadZipFile
+def extract_stream(fileobj, dest='.'):
+	os.makedirs(dest, exist_ok=True)
+	tmp_dir = tempfile.mkdtemp(prefix='.extract_', dir=dest)
+	try:
+		extracted = _extract_members(fileobj, tmp_dir)
+		_move_tree(tmp_dir, dest)
+	except (struct.error, zlib.error) as e: # stream cut inside a header / bad deflate data
+		raise BadZipFile('Corrupt or truncated zip stream: {}'.format(e)) from e
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+	return extracted
+
+
+def _extract_members(fileobj, dest):
+	reader = _StreamBuffer(fileobj)
+	extracted = []
+
+	while True:
+		sig = reader.read(4)
+		if sig != LOCAL_HEADER_SIG:
+			if sig and sig not in END_OF_ENTRIES_SIGS:
+				raise BadZipFile('Unexpected data in zip stream')
+			break
+
+		header = reader.read(struct.calcsize(LOCAL_HEADER_FORMAT))
+		_, flags, method, _, _, crc, csize, usize, name_len, extra_len = struct.unpack(LOCAL_HEADER_FORMAT, header)
+		raw_name = reader.read(name_len)
+		extra = reader.read(extra_len)
+		name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+		is_zip64, csize, usize = _zip64_sizes(extra, csize, usize)
+		has_descriptor = bool(flags & 0x8)
+
+		if flags & 0x1 or method not in (STORED, DEFLATED) or (has_descriptor and method == STORED and not name.endswith('/')):
+			_extract_spooled(reader, sig + header + raw_name + extra, dest, extracted)
+			break
+
+		outfile = _member_path(dest, name)
+		if name.endswith('/'): # directory entries carry no content, but may still have an (empty) compressed stream to skip
+			os.makedirs(outfile, exist_ok=True)
+			if has_descriptor and method == STORED:
+				_read_data_descriptor(reader, is_zip64, 0, 0, 0)
+			else:
+				member_crc, member_csize, member_usize = _extract_member(reader, os.devnull, method, csize, has_descriptor)
+				if has_descriptor:
+					_read_data_descriptor(reader, is_zip64, member_crc, member_csize, member_usize)
+			continue
+
+		os.makedirs(os.path.dirname(outfile), exist_ok=True)
+		member_crc, member_csize, member_usize = _extract_member(reader, outfile, method, csize, has_descriptor)
+		if has_descriptor:
+			_read_data_descriptor(reader, is_zip64, member_crc, member_csize, member_usize)
+		elif (member_crc, member_usize) != (crc, usize):
+			raise BadZipFile('Bad CRC or size for member in zip stream: {}'.format(name))
+		extracted.append(name)
+
+	return extracted
+
+
 def download(sess, url, session_label, overwrite=False):
 	if exists(session_label) and not overwrite:
 		return
 
-	zip_file = session_label + '.zip'
 	r = sess.get(url, params=DOWNLOAD_PARAMS, stream=True)
-	with open(zip_file, 'wb') as f:
-		copyfileobj(r.raw, f)
-	
-	dl = ZipFile(zip_file)
-	dl.extractall('.')
-	dl.close()
-	remove(zip_file)
+	r.raise_for_status()
+	extract_stream(r.raw, '.')
+
+# helper function to hash a (partial) download so it can be verified against the digest CNDA reports
+def md5sum(filename):
+	md5 = hashlib.md5()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			md5.update(chunk)
+	return md5.hexdigest()
+
+
+# fetch url into outfile, resuming from outfile.part with a Range request if a previous attempt was interrupted
+#   the file is only moved into place once its size (and digest, if known) match the resource listing
+def download_file(sess, url, outfile, size=None, digest=None, retries=3):
+	part_file = outfile + '.part'
+	os.makedirs(os.path.dirname(outfile), exist_ok=True)
+
+	for attempt in range(retries + 1):
+		offset = getsize(part_file) if exists(part_file) else 0
+		if size is not None and offset > size:
+			os.remove(part_file)
+			offset = 0
+
+		try:
+			if size is None or offset < size:
+				headers = { 'Range': 'bytes={}-'.format(offset) } if offset else {}
+				r = sess.get(url, headers=headers, stream=True)
+				if r.status_code != RANGE_NOT_SATISFIABLE:
+					r.raise_for_status()
+					mode = 'ab' if offset and r.status_code == PARTIAL_CONTENT else 'wb' # server may ignore the range and send the whole file
+					with open(part_file, mode) as f:
+						for chunk in r.iter_content(TRANSFER_CHUNK_SIZE):
+							f.write(chunk)
+		except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+			print('Transfer interrupted ({}), resuming: {}'.format(e, url))
+			continue
+
+		if (size is None or getsize(part_file) == size) and (not digest or md5sum(part_file) == digest):
+			os.replace(part_file, outfile)
+			return
+
+		print('Size/checksum mismatch, restarting: {}'.format(url))
+		os.remove(part_file)
+
+	raise IOError('Unable to download {} after {} attempts'.format(url, retries + 1))
+
+
+def get_resource_files(sess, base_url, scans, resource):
+	response = sess.get('{}/scans/{}/resources/{}/files'.format(base_url, scans, resource), params=JSON_FORMAT)
+	response.raise_for_status()
+	return get_result_array(response)
+
+
+def read_journal(journal_file):
+	if not exists(journal_file):
+		return {}
+	with open(journal_file) as f:
+		entries = [ json.loads(line) for line in f if line.strip() ]
+	return { entry['path']: (entry['size'], entry['digest']) for entry in entries }
+
+
+# download each file of the scans' resource individually (one listing request per session)
+#   completed files are appended to a journal in the session folder, so an interrupted run skips them and resumes the partial one
+#   files are laid out as <session_label>/scans/<scan_id>/<resource>/<file> to match the simplified zip structure
+def download_resources(sess, base_url, session_label, scans='ALL', resource='DICOM', dest='.', host=HOST, retries=3):
+	session_dir = join(dest, session_label)
+	journal_file = join(session_dir, JOURNAL_FILE)
+	journal = read_journal(journal_file)
+
+	downloaded = []
+	for resource_file in get_resource_files(sess, base_url, scans, resource):
+		scan_id = scan_id_search.search(resource_file['URI']).group(1)
+		relpath = join('scans', scan_id, resource, resource_file['Name'])
+		size = int(resource_file['Size']) if resource_file.get('Size') else None
+		digest = resource_file.get('digest') or None
+
+		outfile = join(session_dir, relpath)
+		if journal.get(relpath) != (size, digest) or not exists(outfile):
+			download_file(sess, host + resource_file['URI'], outfile, size, digest, retries)
+			with open(journal_file, 'a') as f:
+				f.write(json.dumps({ 'path': relpath, 'size': size, 'digest': digest }) + '\n')
+		downloaded.append(relpath)
+
+	return downloaded
+
+
+# per-project record of which scan resources are fully present locally (session -> scan -> resource -> file count/bytes)
+#   used to sync scan-by-scan instead of treating any existing session folder as complete
+class ScanManifest:
+	def __init__(self, project_id, dest='.'):
+		self.manifest_file = join(dest, MANIFEST_TEMPLATE.format(project_id))
+		self.lock = threading.Lock()
+		self.sessions = {}
+		if exists(self.manifest_file):
+			with open(self.manifest_file) as f:
+				self.sessions = json.load(f)
+
+	def get(self, session_label):
+		return self.sessions.get(session_label, {})
+
+	# scans (from a get_scan_resources listing) whose resource is missing or differs from what was recorded
+	def missing_scans(self, session_label, scan_resources, resource, scans=None):
+		recorded = self.get(session_label)
+		missing = []
+		for scan_resource in scan_resources:
+			scan_id = scan_resource['cat_id']
+			if scan_resource['label'] != resource or (scans and scan_id not in scans) or scan_id in missing:
+				continue
+			if recorded.get(scan_id, {}).get(resource) != remote_resource_stats(scan_resource):
+				missing.append(scan_id)
+		return missing
+
+	def record(self, session_label, scan_id, resource, stats):
+		with self.lock:
+			self.sessions.setdefault(session_label, {}).setdefault(scan_id, {})[resource] = stats
+			self.save()
+
+	def save(self):
+		tmp_file = self.manifest_file + '.tmp'
+		with open(tmp_file, 'w') as f:
+			json.dump(self.sessions, f, indent=1, sort_keys=True)
+		os.replace(tmp_file, self.manifest_file)
+
+
+def remote_resource_stats(scan_resource):
+	return { 'file_count': int(scan_resource.get('file_count') or 0), 'file_size': int(scan_resource.get('file_size') or 0) }
+
+
+# helper function to tally extracted files (paths relative to base_dir) by scan id
+def local_scan_stats(paths, base_dir='.'):
+	stats = {}
+	for path in paths:
+		match = scan_dir_search.search(path.replace(os.sep, '/'))
+		if not match:
+			continue
+		scan_stats = stats.setdefault(match.group(1), { 'file_count': 0, 'file_size': 0 })
+		scan_stats['file_count'] += 1
+		scan_stats['file_size'] += getsize(join(base_dir, path))
+	return stats
+
 
 def download_by_session_id(sess, session_id, session_label, scans, resources, host=HOST, overwrite=False):
 	base_url = SHORT_FORM_TEMPLATE.format(host, session_id)
@@ -50,8 +589,14 @@ def download_by_subject_session_label(sess, project_id, subject_id, session_labe
 
 def get_all_sessions(sess, project_id, host=HOST):
 	base_url = '{}/data/projects/{}/experiments'.format(host, project_id)
-	response = sess.get(base_url, params=JSON_FORMAT)
-	return get_result_array(response)
+	sessions = get_cached_result_array(sess, base_url, dict(JSON_FORMAT, columns=SESSION_COLUMNS), ttl=(_cache.listing_ttl if _cache else None))
+	if _cache:
+		_cache.update_sessions(sessions)
+	return sessions
+
+
+def get_subject_sessions(sess, project_id, subject_id, host=HOST):
+	return get_cached_result_array(sess, SUBJECT_SESSION_REQUEST_TEMPLATE.format(host, project_id, subject_id))
 
 
 def get_dcm_tag_info(sess, project_id, session_id, scan_id, fields=None, host=HOST):
@@ -61,21 +606,27 @@ def get_dcm_tag_info(sess, project_id, session_id, scan_id, fields=None, host=HO
 	if fields:
 		params['field'] = fields
 	params = { **params, **JSON_FORMAT }
-	response = sess.get(base_url, params=params)
-	return { tag['desc']: tag['value'] for tag in get_result_array(response) }
+	return { tag['desc']: tag['value'] for tag in get_cached_result_array(sess, base_url, params, session=session_id) }
+
+
+# check a dicomdump ImageType value against the requested duplicate type ('orig' or 'norm')
+def is_image_type(dcm_img_type, img_type):
+	return not (('NORM' in dcm_img_type and img_type == 'orig') or ('NORM' not in dcm_img_type and img_type == 'norm'))
+
+
+# look up ImageType for each scan (concurrently) and return the scans matching img_type, in their original order
+def select_image_type(sess, project_id, session_id, scan_ids, img_type, host=HOST, jobs=TAG_LOOKUP_JOBS):
+	with ThreadPoolExecutor(max_workers=jobs) as executor:
+		tag_info = list(executor.map(lambda scan_id: get_dcm_tag_info(sess, project_id, session_id, scan_id, fields=['ImageType'], host=host), scan_ids))
+	return [ scan_id for scan_id, info in zip(scan_ids, tag_info) if is_image_type(info['Image Type'], img_type) ]
 
 
 def get_scan_info(sess, project_id, subject_id, session_label, host=HOST):
 	base_url = LONG_FORM_TEMPLATE.format(host, project_id, subject_id, session_label)
 	print(base_url)
-	response = sess.get('{}/scans'.format(base_url), params=JSON_FORMAT)
-	return [ (scan['ID'], scan['series_description']) for scan in get_result_array(response) ]
+	return [ (scan['ID'], scan['series_description']) for scan in get_cached_result_array(sess, '{}/scans'.format(base_url), session=session_label) ]
 
 
 def get_scan_resources(sess, session_id, scan_id='ALL', host=HOST):
 	base_url = SHORT_FORM_TEMPLATE.format(host, session_id)
-	response = sess.get('{}/scans/{}/resources'.format(base_url, scan_id), params=JSON_FORMAT)
-	return get_result_array(response) 
-
-
-
+	return get_cached_result_array(sess, '{}/scans/{}/resources'.format(base_url, scan_id), session=session_id)
@@ -1,10 +1,10 @@
 from builtins import input
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
-from os import getcwd, listdir, remove
-from os.path import isdir, join
-from requests.auth import HTTPBasicAuth
-from shutil import copyfileobj
-from subprocess import call
+from os import getcwd, listdir
+from os.path import exists, isdir, join
+from pydicom.errors import InvalidDicomError
+from zipfile import BadZipFile
 
 import argparse
 import fnmatch
@@ -12,86 +12,146 @@ import json
 import requests
 
 import cnda_common
+import header_store
 
-cnda_base_url = 'https://cnda.wustl.edu'
-download_url_template = '/data/projects/{}/subjects/{}/experiments/{}/{}/{}/resources/{}/files?format=zip&structure=simplified'
-subject_list_url_template = '/data/projects/{}/subjects?format=json'
-session_list_url_template = '/data/projects/{}{}/experiments?format=json'
 
-
-def get_auth_session():
+def get_auth_session(pool_size=cnda_common.POOL_SIZE):
 	username = input('CNDA username: ')
-	sess = requests.Session()
-	sess.auth = (username, getpass())
-	return sess
+	return cnda_common.CndaClient((username, getpass()), pool_size=max(pool_size, cnda_common.POOL_SIZE))
 
 
-def get_scans_to_download(sess, project_id, subject, session, scan_types):
-	if not scan_types:
+# if duplicates is set ('orig' or 'norm'), the ImageType of each matching scan is looked up on CNDA so that only the selected
+#   version of duplicate (i.e. ORIG/NORM) scans is requested; scans matching a pattern in keep_all (e.g. functional series) are always kept
+def get_scans_to_download(sess, project_id, subject, session, scan_types, duplicates=None, keep_all=[], session_id=None):
+	if not scan_types and not duplicates:
 		return 'ALL'
 
-	if all(t.isdigit() for t in scan_types):
-		scans = scan_types
+	if scan_types and all(t.isdigit() for t in scan_types): # scan ids: series descriptions are only needed to exempt keep_all scans
+		scans, keep = list(scan_types), []
+		if duplicates and keep_all:
+			series_descs = dict(cnda_common.get_scan_info(sess, project_id, subject, session, sess.host))
+			keep = [ scan for scan in scans if any(fnmatch.fnmatch(series_descs.get(scan, ''), pattern) for pattern in keep_all) ]
 	else:
-		scans = []
-		scan_info = cnda_common.get_scan_info(sess, project_id, subject, session)
+		scans, keep = [], []
+		scan_info = cnda_common.get_scan_info(sess, project_id, subject, session, sess.host)
 		for scan_id, series_desc in scan_info:
-			if any(fnmatch.fnmatch(series_desc, scan_type) for scan_type in scan_types):
-				scans.append(scan_id)
+			if scan_types and not any(fnmatch.fnmatch(series_desc, scan_type) for scan_type in scan_types):
+				continue
+			scans.append(scan_id)
+			if any(fnmatch.fnmatch(series_desc, pattern) for pattern in keep_all):
+				keep.append(scan_id)
+
+	if duplicates: # applies to scan ids and series description patterns alike
+		selected = cnda_common.select_image_type(sess, project_id, session_id, [ scan for scan in scans if scan not in keep ], duplicates, sess.host)
+		scans = [ scan for scan in scans if scan in keep or scan in selected ]
 	return ','.join(scans)
 
 
-def download_dicoms(project_id, subject_id=None, session_label=None, scan_types=None, folder='scans', resources='DICOM', exclusions=[], auth=None):
-	sess = auth if auth else get_auth_session()
-
-	sessions = None
-	warning_msg = ''
+# download + extract a single session (returns the extracted file paths, or None if the download failed)
+#   if resume is set, files are fetched individually with resumable, checksum-verified transfers instead of a single zip
+#   if a manifest is given, only scans whose resource is missing from (or changed since) the manifest are requested
+#   if headers_only is set, only the header of one file per scan is stored (see header_store.prefetch_headers)
+def download_session(sess, project_id, subject, session, scan_types=None, folder='scans', resources='DICOM', resume=False, manifest=None, session_id=None, duplicates=None, keep_all=[], headers_only=False):
+	try:
+		scans = get_scans_to_download(sess, project_id, subject, session, scan_types, duplicates, keep_all, session_id)
+		if manifest is not None:
+			scan_resources = cnda_common.get_scan_resources(sess, session_id, host=sess.host)
+			missing_scans = manifest.missing_scans(session, scan_resources, resources, None if scans == 'ALL' else scans.split(','))
+			if not missing_scans:
+				print('Session {} is up to date'.format(session))
+				return []
+			print('Session {} is missing scans: {}'.format(session, missing_scans))
+			scans = ','.join(missing_scans)
+
+		base_url = cnda_common.LONG_FORM_TEMPLATE.format(sess.host, project_id, subject, session)
+		if headers_only:
+			return header_store.prefetch_headers(sess, base_url, session, scans, resources, host=sess.host)
+		elif resume:
+			extracted = cnda_common.download_resources(sess, base_url, session, scans, resources, host=sess.host)
+		else:
+			url = '{}/{}/{}/resources/{}/files'.format(base_url, folder, scans, resources)
+
+			print('GET', url)
+			r = sess.get(url, params=cnda_common.DOWNLOAD_PARAMS, stream=True)
+			r.raise_for_status()
+			extracted = cnda_common.extract_stream(r.raw)
+	except (requests.RequestException, BadZipFile, InvalidDicomError, OSError) as e:
+		print('Download failed for session {}: {}'.format(session, e))
+		return None
+
+	if not extracted:
+		print('No files found for session: {}'.format(session))
+		return None
+
+	# only record scans whose extracted files add up to what CNDA reports, so partial scans are retried next sync
+	if manifest is not None:
+		local_stats = cnda_common.local_scan_stats(extracted, session if resume else '.')
+		remote_stats = { r['cat_id']: cnda_common.remote_resource_stats(r) for r in scan_resources if r['label'] == resources }
+		for scan_id in missing_scans:
+			if local_stats.get(scan_id) == remote_stats[scan_id]:
+				manifest.record(session, scan_id, resources, remote_stats[scan_id])
+			else:
+				print('Scan {} of session {} is incomplete (local {}, remote {})'.format(scan_id, session, local_stats.get(scan_id), remote_stats[scan_id]))
+
+	return extracted
+
+
+# work out which sessions still need downloading: returns ([ (subject, session) ], manifest or None, { session label: session id })
+#   existing session folders are skipped unless resume/sync/headers_only mean they need re-checking (see download_dicoms)
+def plan_downloads(sess, project_id, subject_id=None, session_label=None, exclusions=[], resume=False, sync=False, duplicates=None, headers_only=False):
 	if session_label:
 		sessions = [ session_label ]
-		warning_msg = 'Session {} has already been downloaded'.format(session_label)
 	else:
 		sessions = get_sessions(project_id, subject_id, sess)
-		warning_msg = 'All sessions are already downloaded'
 
 	existing_sessions = [ d for d in listdir(getcwd()) if isdir(join(getcwd(), d)) ]
+	if resume: # sessions downloaded file-by-file keep a journal, so re-check them in case the last run was interrupted
+		existing_sessions = [ d for d in existing_sessions if not exists(join(d, cnda_common.JOURNAL_FILE)) ]
+	if sync or headers_only: # header store is kept per scan, so existing sessions are checked for new scans
+		existing_sessions = []
 	subject_session_map = [ ((subject_id if subject_id else session.rsplit('_', 1)[0]), session) for session in sessions if session not in existing_sessions + exclusions ]
 	print(subject_session_map)
 
-	if not subject_session_map:
-		print(warning_msg)
+	manifest = cnda_common.ScanManifest(project_id) if sync and subject_session_map else None
+	session_ids = {}
+	if subject_session_map and (sync or duplicates): # session ids are needed for the scan resource / dicomdump requests
+		session_ids = { s['label']: s['ID'] for s in cnda_common.get_all_sessions(sess, project_id, sess.host) }
+		subject_session_map = [ tup for tup in subject_session_map if tup[1] in session_ids ]
 
+	return subject_session_map, manifest, session_ids
 
-	downloaded_sessions = []
-	for tup in subject_session_map:
-		scans = get_scans_to_download(sess, project_id, tup[0], tup[1], scan_types)
-		url = cnda_base_url + download_url_template.format(project_id, tup[0], tup[1], folder, scans, resources)
-		zip_file = '.'.join([tup[1], 'zip'])
 
-		print('GET', url)
-		r = sess.get(url, stream=True)
-		with open(zip_file, 'wb') as f:
-			copyfileobj(r.raw, f)
+# if sync is set, existing sessions are topped up scan-by-scan against the project manifest (<project_id>_manifest.json)
+# if duplicates is set, only the chosen ImageType of duplicate scans is downloaded (see get_scans_to_download)
+# if headers_only is set, sessions are only fetched into the local header store (<session>/headers/<scan_id>/)
+def download_dicoms(project_id, subject_id=None, session_label=None, scan_types=None, folder='scans', resources='DICOM', exclusions=[], auth=None, jobs=1, resume=False, sync=False, duplicates=None, keep_all=[], headers_only=False):
+	sess = auth if auth else get_auth_session(jobs)
 
-		try:
-			call(['unzip', zip_file])
-			remove(zip_file)
-			downloaded_sessions.append(tup[1])
-		except:
-			print('Empty zip for session: {}'.format(tup[1]))
+	subject_session_map, manifest, session_ids = plan_downloads(sess, project_id, subject_id, session_label, exclusions, resume, sync, duplicates, headers_only)
+	if not subject_session_map:
+		print('Session {} has already been downloaded'.format(session_label) if session_label else 'All sessions are already downloaded')
+		return []
 
-	return downloaded_sessions
+	# sessions are fetched by a bounded pool sharing one session (jobs=1 keeps the original serial behavior)
+	with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+		futures = [ executor.submit(download_session, sess, project_id, subject, session, scan_types, folder, resources, resume, manifest, session_ids.get(session), duplicates, keep_all, headers_only) for subject, session in subject_session_map ]
+		results = [ future.result() for future in futures ]
+
+	# results are collected in submission order so the returned list does not depend on completion order
+	downloaded_sessions = [ session for (_, session), extracted in zip(subject_session_map, results) if extracted ]
+	failed_sessions = [ session for (_, session), extracted in zip(subject_session_map, results) if extracted is None ]
 
+	print('Downloaded {} of {} sessions'.format(len(downloaded_sessions), len(subject_session_map)))
+	if failed_sessions:
+		print('Failed sessions:', ' '.join(failed_sessions))
 
-def get_result_list(url, sess):
-	print(url)
-	r = sess.get(url)
-	return [ result['label'] for result in r.json()['ResultSet']['Result'] ]
+	return downloaded_sessions
 
 
 def get_sessions(project_id, subject_id, sess):
-	subject_str = '/subjects/' + subject_id if subject_id else ''
-	url = cnda_base_url + session_list_url_template.format(project_id, subject_str)
-	return get_result_list(url, sess)
+	if not subject_id: # project listing goes through cnda_common so the metadata cache can drop results for changed sessions
+		return [ session['label'] for session in cnda_common.get_all_sessions(sess, project_id, sess.host) ]
+	return [ session['label'] for session in cnda_common.get_subject_sessions(sess, project_id, subject_id, sess.host) ]
 
 
 if __name__ == '__main__':
@@ -100,6 +160,14 @@ if __name__ == '__main__':
 	parser.add_argument('--subject_id', help='CNDA subject to download (default is all subjects not present in folder)')
 	parser.add_argument('--session_label', help='CNDA session to download (default is all sessions not present in folder')
 	parser.add_argument('--scan_types', nargs='+', help='scan types to download (default is all scan types)')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='number of sessions to download/extract concurrently (default is 1)')
+	parser.add_argument('--resume', action='store_true', help='download files individually with resumable, checksum-verified transfers (interrupted sessions are picked up on the next run)')
+	parser.add_argument('--sync', action='store_true', help='top up existing sessions with any scans missing from the project manifest (<project_id>_manifest.json)')
+	parser.add_argument('-d', '--duplicates', choices=['orig', 'norm'], help='if there are duplicate scans, which Image Type to download (default downloads all)')
+	parser.add_argument('--keep_all', nargs='+', default=[], help='series descriptions (unix-style patterns) exempt from duplicate filtering, e.g. BOLD runs')
+	parser.add_argument('--headers_only', action='store_true', help='only fetch the DICOM header of one file per scan into <session>/headers/<scan_id>/')
 	args = parser.parse_args()
 
-	download_dicoms(args.project_id, args.subject_id, args.session_label, args.scan_types)
+	sess = get_auth_session(args.jobs)
+	download_dicoms(args.project_id, args.subject_id, args.session_label, args.scan_types, jobs=args.jobs, resume=args.resume, sync=args.sync, duplicates=args.duplicates, keep_all=args.keep_all, headers_only=args.headers_only, auth=sess)
+	print(sess.metrics.report())
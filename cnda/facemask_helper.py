@@ -1,63 +1,152 @@
 import argparse
+import asyncio
 import cnda_common
 import csv
 import re
 import requests
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from getpass import getpass
 from os.path import exists
 
+RETRY_BACKOFF = 0.5 # seconds, doubled on each retry
+RETRYABLE_STATUS = [ 429, 500, 502, 503, 504 ]
 
-def get_unmasked_sessions(project_id, user, scan_types=None, from_date=None, download=False, img_type=None):
-	sess = requests.Session()
-	sess.auth = (user, getpass('CNDA password:'))
 
-	rows = []
-	project_sessions = cnda_common.get_all_sessions(sess, project_id)
-	for session in project_sessions:
-		subject_id = session['label'].split('_')[0]
+# helper function to group the selected scan resources by scan id (preserves listing order)
+def map_scan_resources(scan_resources, scan_types=None, img_types=None, img_type=None):
+	id_resource_map = {}
+	for resource in scan_resources:
+		if scan_types and not any(re.search(scantype, resource['cat_desc']) for scantype in scan_types):
+			continue
 
-		if from_date and datetime.strptime(session['insert_date'][:10], '%Y-%m-%d') < from_date:
+		if img_type and not cnda_common.is_image_type(img_types[resource['cat_id']], img_type):
 			continue
 
-		scan_resources = cnda_common.get_scan_resources(sess, session['ID'])
+		if resource['cat_id'] not in id_resource_map:
+			id_resource_map[resource['cat_id']] = []
+		id_resource_map[resource['cat_id']].append(resource['label'])
+	return id_resource_map
+
+
+# returns (csv row or None, scans that already have a defaced resource)
+def summarize_session(session, id_resource_map):
+	unfacemasked_scans = [ scan_id for scan_id, resource_list in id_resource_map.items() if 'DICOM_DEFACED' not in resource_list ]
+	facemasked_scans = [ scan_id for scan_id in id_resource_map.keys() if scan_id not in unfacemasked_scans ]
+
+	row = None
+	if unfacemasked_scans:
+		print('unmasked:', session['label'], unfacemasked_scans )
+		row = [session['label'], ';'.join(unfacemasked_scans)]
+	return row, facemasked_scans
+
+
+def select_sessions(project_sessions, from_date=None):
+	return [ session for session in project_sessions if not from_date or datetime.strptime(session['insert_date'][:10], '%Y-%m-%d') >= from_date ]
+
+
+def crawl_serial(sess, project_id, sessions, scan_types=None, download=False, img_type=None, host=cnda_common.HOST):
+	rows = []
+	for session in sessions:
+		scan_resources = cnda_common.get_scan_resources(sess, session['ID'], host=host)
 		print(session['label'])
 
-		id_resource_map = {}
-		for resource in scan_resources:
-			if scan_types and not any(re.search(scantype, resource['cat_desc']) for scantype in scan_types):
-				continue
+		img_types = {}
+		if img_type:
+			scan_ids = { resource['cat_id'] for resource in scan_resources if not scan_types or any(re.search(scantype, resource['cat_desc']) for scantype in scan_types) }
+			img_types = { scan_id: cnda_common.get_dcm_tag_info(sess, project_id, session['ID'], scan_id, fields=['ImageType'], host=host)['Image Type'] for scan_id in scan_ids }
 
+		row, facemasked_scans = summarize_session(session, map_scan_resources(scan_resources, scan_types, img_types, img_type))
+		if row:
+			rows.append(row)
+
+		if download and facemasked_scans:
+			print('downloading', facemasked_scans)
+			cnda_common.download_by_session_id(sess, session['ID'], session['label'], ','.join(map(str,facemasked_scans)), 'DICOM_DEFACED', host=host)
+
+	return rows
+
+
+def is_retryable(error):
+	if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+		return True
+	return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code in RETRYABLE_STATUS
+
+
+# asyncio version of crawl_serial: up to jobs sessions are crawled at once, with at most host_connections requests in flight
+#   DICOM_DEFACED downloads are started as soon as a session has been checked and overlap the rest of the crawl
+#   (with their own executor and limit, so long transfers do not hold request slots and stall the crawl)
+#   rows are returned in project listing order (same as the serial crawl)
+async def crawl_async(sess, project_id, sessions, scan_types=None, download=False, img_type=None, host=cnda_common.HOST, jobs=8, host_connections=8, retries=3):
+	loop = asyncio.get_running_loop()
+	request_executor = ThreadPoolExecutor(max_workers=host_connections)
+	download_executor = ThreadPoolExecutor(max_workers=host_connections)
+	connection_limit = asyncio.Semaphore(host_connections)
+	download_limit = asyncio.Semaphore(host_connections)
+	session_limit = asyncio.Semaphore(jobs)
+
+	async def fetch(func, *args, executor=request_executor, limit=connection_limit, **kwargs):
+		for attempt in range(retries + 1):
+			try:
+				async with limit:
+					return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+			except requests.RequestException as e:
+				if attempt == retries or not is_retryable(e):
+					raise
+				delay = RETRY_BACKOFF * 2 ** attempt
+				print('Retrying in {}s ({})'.format(delay, e))
+				await asyncio.sleep(delay)
+
+	downloads = []
+
+	async def crawl(session):
+		async with session_limit:
+			scan_resources = await fetch(cnda_common.get_scan_resources, sess, session['ID'], host=host)
+			print(session['label'])
+
+			img_types = {}
 			if img_type:
-				dcm_img_type = cnda_common.get_dcm_tag_info(sess, project_id, session['ID'], resource['cat_id'], fields=['ImageType'])['Image Type']
-				if ('NORM' in dcm_img_type and img_type == 'orig') or ('NORM' not in dcm_img_type and img_type == 'norm'):
-					continue
+				scan_ids = sorted({ resource['cat_id'] for resource in scan_resources if not scan_types or any(re.search(scantype, resource['cat_desc']) for scantype in scan_types) })
+				tag_info = await asyncio.gather(*[ fetch(cnda_common.get_dcm_tag_info, sess, project_id, session['ID'], scan_id, fields=['ImageType'], host=host) for scan_id in scan_ids ])
+				img_types = { scan_id: info['Image Type'] for scan_id, info in zip(scan_ids, tag_info) }
 
-			if resource['cat_id'] not in id_resource_map:
-				id_resource_map[resource['cat_id']] = []
-			id_resource_map[resource['cat_id']].append(resource['label'])
+		row, facemasked_scans = summarize_session(session, map_scan_resources(scan_resources, scan_types, img_types, img_type))
+		if download and facemasked_scans:
+			print('downloading', facemasked_scans)
+			downloads.append(asyncio.ensure_future(fetch(cnda_common.download_by_session_id, sess, session['ID'], session['label'], ','.join(map(str,facemasked_scans)), 'DICOM_DEFACED', host=host, executor=download_executor, limit=download_limit)))
+		return row
 
+	try:
+		rows = await asyncio.gather(*[ crawl(session) for session in sessions ])
+		await asyncio.gather(*downloads)
+	finally:
+		request_executor.shutdown()
+		download_executor.shutdown()
 
-		unfacemasked_scans = [ scan_id for scan_id, resource_list in id_resource_map.items() if 'DICOM_DEFACED' not in resource_list ]
-		if unfacemasked_scans:
-			print('unmasked:', session['label'], unfacemasked_scans )
-			rows.append([session['label'], ';'.join(unfacemasked_scans)])
+	return [ row for row in rows if row ]
 
-		if download:
-			facemasked_scans = [ scan_id for scan_id in id_resource_map.keys() if scan_id not in unfacemasked_scans ]
-			if not facemasked_scans:
-				continue
 
-			print('downloading', facemasked_scans)
-			cnda_common.download_by_session_id(sess, session['ID'], session['label'], ','.join(map(str,facemasked_scans)), 'DICOM_DEFACED')
+def get_unmasked_sessions(project_id, user, scan_types=None, from_date=None, download=False, img_type=None, jobs=1, host=cnda_common.HOST):
+	sess = cnda_common.CndaClient((user, getpass('CNDA password:')), host=host, pool_size=max(jobs, cnda_common.POOL_SIZE))
 
+	project_sessions = cnda_common.get_all_sessions(sess, project_id, host=host)
+	sessions = select_sessions(project_sessions, from_date)
+
+	if jobs > 1:
+		rows = asyncio.run(crawl_async(sess, project_id, sessions, scan_types, download, img_type, host, jobs=jobs, host_connections=jobs))
+	else:
+		rows = crawl_serial(sess, project_id, sessions, scan_types, download, img_type, host)
 
 	with open('facemask_missing.csv', 'w', newline='') as f:
 		writer = csv.writer(f)
 		writer.writerows(rows)
 
+	print(cnda_common.cache_stats())
+	print(sess.metrics.report())
+
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
@@ -67,7 +156,11 @@ if __name__ == '__main__':
 	parser.add_argument('--from_date', type=lambda d: datetime.strptime(d, '%Y-%m-%d'), help='limit results to sessions after date')
 	parser.add_argument('-d', '--download', action='store_true', help='download facemasked sessions?')
 	parser.add_argument('--imgtype', choices=['orig','norm'], help='download specified version of image')
+	parser.add_argument('--cache', nargs='?', const=cnda_common.CACHE_FILE, help='cache CNDA metadata in sqlite file (default {}) so repeat runs only query new/changed sessions'.format(cnda_common.CACHE_FILE))
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='crawl sessions concurrently with up to this many requests in flight (default is 1, i.e. serial)')
 	args = parser.parse_args()
 
 	print(args)
-	get_unmasked_sessions(args.project_id, args.user, args.scan_types, args.from_date, args.download, args.imgtype)
+	if args.cache:
+		cnda_common.enable_cache(args.cache)
+	get_unmasked_sessions(args.project_id, args.user, args.scan_types, args.from_date, args.download, args.imgtype, args.jobs)
@@ -0,0 +1,55 @@
+import io
+import os
+import pydicom
+
+import cnda_common
+
+HEADER_DIR = 'headers'
+HEADER_PREFIX_SIZE = 64 * 1024 # bytes requested per file; enough for the header (incl. Siemens CSA tags) of most MR DICOMs
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00' # (7FE0,0010) little endian
+
+
+# local header store layout: <session_label>/headers/<scan_id>/<file> (pixel data stripped)
+def header_dir(session_dir, scan_id='*'):
+	return os.path.join(session_dir, HEADER_DIR, scan_id)
+
+
+# fetch only the start of a DICOM file with a Range request and parse the header from it
+#   falls back to the whole file if the header does not fit in the prefix (e.g. very large private tags)
+def fetch_header(sess, url, prefix_size=HEADER_PREFIX_SIZE):
+	r = sess.get(url, headers={ 'Range': 'bytes=0-{}'.format(prefix_size - 1) }, stream=True)
+	r.raise_for_status()
+	data = r.raw.read(prefix_size, decode_content=True) # server may ignore the range, so stop reading after the prefix either way
+	r.close()
+
+	if len(data) == prefix_size and PIXEL_DATA_TAG not in data:
+		r = sess.get(url)
+		r.raise_for_status()
+		data = r.content
+
+	return pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True)
+
+
+# store the header of one representative file per scan (or of every file if all_files is set, e.g. for vNav setter comments)
+#   existing headers are kept, so re-running only fetches scans that are new to the store
+def prefetch_headers(sess, base_url, session_label, scans='ALL', resource='DICOM', dest='.', all_files=False, host=cnda_common.HOST):
+	session_dir = os.path.join(dest, session_label)
+	resource_files = sorted(cnda_common.get_resource_files(sess, base_url, scans, resource), key=lambda f: f['Name'])
+
+	stored, seen_scans = [], set()
+	for resource_file in resource_files:
+		scan_id = cnda_common.scan_id_search.search(resource_file['URI']).group(1)
+		if scan_id in seen_scans and not all_files:
+			continue
+		seen_scans.add(scan_id)
+
+		outfile = os.path.join(header_dir(session_dir, scan_id), resource_file['Name'])
+		if not os.path.exists(outfile):
+			print('Fetching header', resource_file['URI'])
+			ds = fetch_header(sess, host + resource_file['URI'])
+			os.makedirs(os.path.dirname(outfile), exist_ok=True)
+			ds.save_as(outfile)
+		stored.append(outfile)
+
+	return stored
+
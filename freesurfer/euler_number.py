@@ -2,53 +2,125 @@ import argparse
 import csv
 import os
 import re
+import sqlite3
 
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from fs_surface import surface_euler as native_euler
+from study_index import get_study_index
 from subprocess import run, PIPE
 
 input_search = re.compile('MR\.head_\w+\.(\d+)')
 euler_num_search = re.compile('= (-*\d+) -->')
 
-def extract_euler(subjects_dir, outfile, surf_dirs):
-	results = [ ['patid', 'scan', 'lh_euler', 'rh_euler'] ]
+CACHE_FILE = '.euler_cache.sqlite' # per subjects_dir; euler number of each ?h.orig.nofix, keyed on path + mtime
+
+
+# input scan number from the CMDARGS line of recon-all.done (None if the subject has not finished / input not found)
+def read_input_scan(logfile):
+	if not os.path.exists(logfile):
+		return None
+	with open(logfile, errors='replace') as f:
+		for line in f:
+			if 'CMDARGS' in line:
+				search_res = input_search.search(line)
+				return search_res.group(1) if search_res else None
+	return None
+
+
+def surface_euler(surf):
+	print('Processing {}...'.format(surf))
+	return str(native_euler(surf)) # read directly from the surface file (see fs_surface.py), no FreeSurfer install needed
+
+
+# reference value from FreeSurfer (None if its output could not be parsed)
+def mris_euler(surf):
+	search_res = euler_num_search.search(run(['mris_euler_number', surf], stderr=PIPE).stderr.decode()) # response goes to stderr (not sure why)
+	return search_res.group(1) if search_res else None
+
+
+# compare the native euler numbers against mris_euler_number, returns [ (surf, native, mris) ] for any that differ
+def validate_euler(surfs, jobs=1):
+	with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+		mris = list(executor.map(mris_euler, surfs))
+	native = [ str(native_euler(surf)) for surf in surfs ]
+	mismatches = [ (surf, num, ref) for surf, num, ref in zip(surfs, native, mris) if num != ref ]
+	print('{} of {} surfaces differ from mris_euler_number'.format(len(mismatches), len(surfs)))
+	for mismatch in mismatches:
+		print('{}: native {}, mris_euler_number {}'.format(*mismatch))
+	return mismatches
+
+
+class EulerCache:
+	def __init__(self, subjects_dir):
+		self.conn = sqlite3.connect(os.path.join(subjects_dir, CACHE_FILE))
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS surfaces (path TEXT PRIMARY KEY, mtime REAL, euler TEXT)')
+
+	def get(self, surf, mtime):
+		row = self.conn.execute('SELECT euler FROM surfaces WHERE path = ? AND mtime = ?', (surf, mtime)).fetchone()
+		return row[0] if row else None
+
+	def update(self, values):
+		with self.conn:
+			self.conn.executemany('INSERT OR REPLACE INTO surfaces VALUES (?, ?, ?)', values)
+
+
+# rows of an existing results csv, keyed by patid (so a run over some subjects only replaces their rows)
+def read_results(outfile):
+	if not os.path.exists(outfile):
+		return {}
+	with open(outfile) as f:
+		reader = csv.reader(f)
+		next(reader, None)
+		return { row[0]: row for row in reader if row }
+
+
+# euler numbers (V - E + F, read natively by fs_surface.py) are only computed for surfaces that are new or changed since the last run (by mtime), jobs at a time;
+#   results are merged into outfile (default <subjects_dir>/euler_numbers.csv)
+#   if validate is set, the surfaces are also run through mris_euler_number and any differences reported
+def extract_euler(subjects_dir, outfile, surf_dirs, jobs=1, validate=False):
+	cache = EulerCache(subjects_dir)
+	surfs, todo = {}, {}
 	for d in surf_dirs:
-		patid = d.split(os.sep)[-2] # get subject folder name
-		logfile = os.path.join(os.path.dirname(d), 'scripts', 'recon-all.done')
-		if os.path.exists(logfile):
-			print(logfile)
-			input_args = run(['grep', 'CMDARGS', logfile], stdout=PIPE).stdout.decode()
-			search_res = input_search.search(input_args)
-			input_scan = search_res.group(1) if search_res else None
-		else:
-			input_scan = None
-
-		euler_nums = []
 		for hemi in [ 'lh', 'rh' ]:
-			surf = os.path.join(d, '{}.orig.nofix'.format(hemi))
-			print('Processing {}...'.format(surf))
-
+			surf = os.path.abspath(os.path.join(d, '{}.orig.nofix'.format(hemi)))
 			if not os.path.exists(surf):
-				euler_nums.append(None)
 				continue
+			mtime = os.stat(surf).st_mtime
+			surfs[surf] = cache.get(surf, mtime)
+			if surfs[surf] is None:
+				todo[surf] = mtime
 
-			num = euler_num_search.search(run(['mris_euler_number', surf], stderr=PIPE).stderr.decode()).group(1) # response goes to stderr (not sure why)
-			euler_nums.append(num)
-
-		results.append([patid, input_scan] + euler_nums)
+	print('{} of {} surfaces to process'.format(len(todo), len(surfs)))
+	with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+		computed = dict(zip(todo, executor.map(surface_euler, todo)))
+	cache.update([ (surf, todo[surf], num) for surf, num in computed.items() ])
+	surfs.update(computed)
+	if validate:
+		validate_euler(list(surfs), jobs)
 
 	outfile = outfile if outfile else os.path.join(subjects_dir, 'euler_numbers.csv')
+	results = read_results(outfile)
+	for d in surf_dirs:
+		patid = os.path.abspath(d).split(os.sep)[-2] # get subject folder name
+		input_scan = read_input_scan(os.path.join(os.path.dirname(d), 'scripts', 'recon-all.done'))
+		results[patid] = [patid, input_scan] + [ surfs.get(os.path.abspath(os.path.join(d, '{}.orig.nofix'.format(hemi)))) for hemi in [ 'lh', 'rh' ] ]
+
 	with open(outfile, 'w') as f:
 		writer = csv.writer(f)
-		writer.writerows(results)
+		writer.writerow(['patid', 'scan', 'lh_euler', 'rh_euler'])
+		writer.writerows(results[patid] for patid in sorted(results))
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('subjects_dir')
 	parser.add_argument('-o', '--outfile', help='where to store group results')
 	parser.add_argument('--subj_pattern', help='patid matching pattern (unix-style)')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='number of surfaces to process concurrently (default is 1)')
+	parser.add_argument('--validate', action='store_true', help='check results against mris_euler_number (requires FreeSurfer)')
 	args = parser.parse_args()
 
 	subj_pattern = args.subj_pattern if args.subj_pattern else '*'
-	surf_dirs = glob(os.path.join(args.subjects_dir, '**', subj_pattern, 'surf'), recursive=True)
+	surf_dirs = [ os.path.join(subject_dir, 'surf') for subject_dir in get_study_index(args.subjects_dir).fs_subjects(subj_pattern) ]
 
-	extract_euler(args.subjects_dir, args.outfile, surf_dirs)
+	extract_euler(args.subjects_dir, args.outfile, surf_dirs, args.jobs, args.validate)
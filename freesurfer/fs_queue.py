@@ -0,0 +1,178 @@
+import argparse
+import fcntl
+import os
+import sqlite3
+import sys
+import time
+
+QUEUE_FILE = '.fs_queue.sqlite'
+POLL_INTERVAL = 30 # seconds between runner checks
+CORES_PER_JOB = 1 # recon-all is single threaded unless run with -openmp/-parallel
+MEM_PER_JOB = 4 * 1024 * 1024 # KB; default recon-all memory estimate (raised to the largest peak RSS seen so far)
+RAMP_TIME = 15 * 60 # seconds a newly started job is assumed not to have reached its peak memory yet
+
+
+# MemAvailable from /proc/meminfo (KB)
+def mem_available():
+	with open('/proc/meminfo') as f:
+		return next(int(line.split()[1]) for line in f if line.startswith('MemAvailable:'))
+
+
+def pid_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+
+# persistent FIFO of FreeSurfer call scripts (e.g. <session>/<session>_fs_call.csh from gen_fs_calls.csh)
+#   stored in <dir>/.fs_queue.sqlite, so queued jobs survive restarts; jobs are run by a single runner process (see run_queue)
+class JobQueue:
+	def __init__(self, queue_file=QUEUE_FILE):
+		self.queue_file = os.path.abspath(queue_file)
+		self.conn = sqlite3.connect(self.queue_file, timeout=30) # submitters and the runner share the file
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, script TEXT, status TEXT, submitted REAL, started REAL, finished REAL, pid INTEGER, returncode INTEGER, runtime REAL, peak_rss INTEGER, log TEXT)')
+
+	# returns the job id (an already queued/running job for the same script is not submitted twice)
+	def submit(self, script):
+		script = os.path.abspath(script)
+		with self.conn:
+			row = self.conn.execute('SELECT id FROM jobs WHERE script = ? AND status IN (\'queued\', \'running\')', (script,)).fetchone()
+			if row:
+				return row[0]
+			return self.conn.execute('INSERT INTO jobs (script, status, submitted, log) VALUES (?, \'queued\', ?, ?)', (script, time.time(), os.path.splitext(script)[0] + '.log')).lastrowid
+
+	def next_queued(self):
+		return self.conn.execute('SELECT id, script, log FROM jobs WHERE status = \'queued\' ORDER BY id LIMIT 1').fetchone()
+
+	def running(self):
+		return self.conn.execute('SELECT id, pid, started FROM jobs WHERE status = \'running\'').fetchall()
+
+	def mark_started(self, job_id, pid):
+		with self.conn:
+			self.conn.execute('UPDATE jobs SET status = \'running\', started = ?, pid = ? WHERE id = ?', (time.time(), pid, job_id))
+
+	def mark_finished(self, job_id, returncode, peak_rss=None, status=None):
+		finished = time.time()
+		with self.conn:
+			self.conn.execute('UPDATE jobs SET status = ?, finished = ?, returncode = ?, runtime = ? - started, peak_rss = ? WHERE id = ?',
+				(status if status else ('done' if returncode == 0 else 'failed'), finished, returncode, finished, peak_rss, job_id))
+
+	def max_peak_rss(self):
+		return self.conn.execute('SELECT MAX(peak_rss) FROM jobs WHERE status = \'done\'').fetchone()[0]
+
+	def jobs(self):
+		return self.conn.execute('SELECT id, status, script, runtime, peak_rss, returncode FROM jobs ORDER BY id').fetchall()
+
+
+# start a job detached from the runner's terminal, logging to its log file
+def spawn(script, log):
+	fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+	try:
+		return os.posix_spawnp('csh', ['csh', script], os.environ, file_actions=[(os.POSIX_SPAWN_DUP2, fd, 1), (os.POSIX_SPAWN_DUP2, fd, 2)], setsid=True)
+	finally:
+		os.close(fd)
+
+
+# run queued jobs until the queue is empty, at most max_jobs at a time and only while there is memory for another one
+#   (MemAvailable minus what recently started jobs are still expected to grow into); runtime and peak RSS are read from wait4
+#   only one runner per queue file (returns immediately if another runner holds the lock)
+def run_queue(queue_file=QUEUE_FILE, max_jobs=None, mem_per_job=MEM_PER_JOB, poll=POLL_INTERVAL):
+	queue = JobQueue(queue_file)
+	lock = open(queue.queue_file + '.lock', 'w')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		print('Queue runner already active for', queue.queue_file)
+		return
+
+	max_jobs = max_jobs if max_jobs else max(1, os.cpu_count() // CORES_PER_JOB)
+	children = {} # pid -> job id, for jobs started by this runner
+
+	# jobs left running by a previous runner are no longer our children: follow them until they exit, without resource usage
+	adopted = { pid: job_id for job_id, pid, _ in queue.running() }
+
+	while True:
+		for pid, job_id in list(children.items()):
+			done_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+			if done_pid:
+				queue.mark_finished(job_id, os.waitstatus_to_exitcode(status), rusage.ru_maxrss) # KB on linux, includes reaped descendants
+				del children[pid]
+		for pid, job_id in list(adopted.items()):
+			if not pid_alive(pid):
+				queue.mark_finished(job_id, None, status='unknown')
+				del adopted[pid]
+
+		estimate = max(mem_per_job, queue.max_peak_rss() or 0)
+		ramping = sum(1 for _, _, started in queue.running() if time.time() - started < RAMP_TIME)
+		job = queue.next_queued()
+		while job and len(children) + len(adopted) < max_jobs and mem_available() - ramping * estimate >= estimate:
+			job_id, script, log = job
+			pid = spawn(script, log)
+			queue.mark_started(job_id, pid)
+			children[pid] = job_id
+			print('Started job {} ({}), pid {}'.format(job_id, script, pid))
+			ramping += 1
+			job = queue.next_queued()
+
+		if not job and not children and not adopted:
+			break
+		time.sleep(poll)
+
+	lock.close()
+
+
+# start a detached runner for queue_file unless one is already running
+def ensure_runner(queue_file=QUEUE_FILE, max_jobs=None, mem_per_job=MEM_PER_JOB):
+	args = [sys.executable, os.path.abspath(__file__), '--queue_file', os.path.abspath(queue_file), 'run', '--mem_per_job', str(mem_per_job)]
+	if max_jobs:
+		args += ['--max_jobs', str(max_jobs)]
+	log = os.open(os.path.abspath(queue_file) + '.log', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+	try:
+		os.posix_spawn(sys.executable, args, os.environ, file_actions=[(os.POSIX_SPAWN_DUP2, log, 1), (os.POSIX_SPAWN_DUP2, log, 2)], setsid=True) # exits at once if a runner holds the lock
+	finally:
+		os.close(log)
+
+
+def submit(scripts, queue_file=QUEUE_FILE, start=True, max_jobs=None, mem_per_job=MEM_PER_JOB):
+	queue = JobQueue(queue_file)
+	job_ids = [ queue.submit(script) for script in scripts ]
+	if start:
+		ensure_runner(queue_file, max_jobs, mem_per_job)
+	return job_ids
+
+
+def status(queue_file=QUEUE_FILE):
+	jobs = JobQueue(queue_file).jobs()
+	counts = {}
+	print('{: >4}  {: <8} {: >10} {: >12} {: >4}  {}'.format('id', 'status', 'runtime (h)', 'peak RSS (GB)', 'rc', 'script'))
+	for job_id, job_status, script, runtime, peak_rss, returncode in jobs:
+		counts[job_status] = counts.get(job_status, 0) + 1
+		print('{: >4}  {: <8} {: >10} {: >12} {: >4}  {}'.format(job_id, job_status, '{:.2f}'.format(runtime / 3600) if runtime else '', '{:.2f}'.format(peak_rss / 1024 ** 2) if peak_rss else '', '' if returncode is None else returncode, script))
+	print(', '.join('{}: {}'.format(k, v) for k, v in sorted(counts.items())))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='local FreeSurfer job queue, limited by cores and available memory')
+	parser.add_argument('--queue_file', default=QUEUE_FILE, help='sqlite file holding the queue (default {} in the current directory)'.format(QUEUE_FILE))
+	subparsers = parser.add_subparsers(dest='command')
+	submit_parser = subparsers.add_parser('submit', help='queue FreeSurfer call scripts (and start a runner if none is active)')
+	submit_parser.add_argument('scripts', nargs='+')
+	submit_parser.add_argument('--no_start', action='store_true', help='only queue the scripts')
+	run_parser = subparsers.add_parser('run', help='run queued jobs in the foreground until the queue is empty')
+	for p in [ submit_parser, run_parser ]:
+		p.add_argument('--max_jobs', type=int, help='maximum concurrent jobs (default = number of cores / {})'.format(CORES_PER_JOB))
+		p.add_argument('--mem_per_job', type=int, default=MEM_PER_JOB, help='memory (KB) to keep free per starting job (default {})'.format(MEM_PER_JOB))
+	subparsers.add_parser('status', help='show queued, running and finished jobs with runtime and peak RSS')
+	args = parser.parse_args()
+
+	if args.command == 'submit':
+		submit(args.scripts, args.queue_file, not args.no_start, args.max_jobs, args.mem_per_job)
+	elif args.command == 'run':
+		run_queue(args.queue_file, args.max_jobs, args.mem_per_job)
+	else:
+		status(args.queue_file)
@@ -0,0 +1,45 @@
+import argparse
+import numpy as np
+
+TRIANGLE_MAGIC = b'\xff\xff\xfe' # FreeSurfer triangle surface file (e.g. ?h.orig.nofix, ?h.white)
+
+
+# memory-mapped (vertices, faces) of a FreeSurfer triangle surface file
+#   layout: magic, 'created by' line ending in '\n\n', big-endian int32 vertex and face counts, float32 xyz per vertex, int32 vertex triple per face
+def read_surface(surf):
+	with open(surf, 'rb') as f:
+		if f.read(3) != TRIANGLE_MAGIC:
+			raise ValueError('{} is not a FreeSurfer triangle surface'.format(surf))
+		header = f.read(1024) # created by line is short; counts follow its blank line
+	end = header.find(b'\n\n')
+	if end < 0:
+		raise ValueError('{}: could not find end of surface header'.format(surf))
+
+	offset = 3 + end + 2
+	nvertices, nfaces = np.frombuffer(header[end+2:end+10], dtype='>i4')
+	vertices = np.memmap(surf, dtype='>f4', mode='r', offset=offset + 8, shape=(nvertices, 3))
+	faces = np.memmap(surf, dtype='>i4', mode='r', offset=offset + 8 + vertices.nbytes, shape=(nfaces, 3))
+	return vertices, faces
+
+
+# V - E + F, with edges counted as unique (sorted) vertex pairs over all face sides
+def euler_characteristic(nvertices, faces):
+	faces = np.asarray(faces, dtype=np.int64)
+	edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+	edges.sort(axis=1)
+	nedges = np.unique(edges[:, 0] * nvertices + edges[:, 1]).size
+	return int(nvertices - nedges + len(faces))
+
+
+def surface_euler(surf):
+	vertices, faces = read_surface(surf)
+	return euler_characteristic(len(vertices), faces)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='euler number (V - E + F) of FreeSurfer surface files, without FreeSurfer')
+	parser.add_argument('surfs', nargs='+')
+	args = parser.parse_args()
+
+	for surf in args.surfs:
+		print(surf, surface_euler(surf))
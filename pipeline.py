@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+
+DONE = object() # end-of-input marker passed between stages
+
+
+# one step of a Pipeline: func(item) returns the item handed to the next stage (None drops it, e.g. nothing to do)
+#   workers is the stage's concurrency limit; queue_size bounds how many items can wait for the stage (default 2 per worker)
+class Stage:
+	def __init__(self, name, func, workers=1, queue_size=None):
+		self.name = name
+		self.func = func
+		self.workers = max(workers, 1)
+		self.queue = queue.Queue(maxsize=queue_size if queue_size else 2 * self.workers)
+		self.timings = [] # (item, seconds waiting in queue, seconds running)
+		self.errors = {}
+		self.lock = threading.Lock()
+
+
+# runs items through stages connected by bounded queues: each item moves on as soon as its previous stage finishes,
+#   so e.g. a session can be set up while others are still downloading; a full queue blocks the stage feeding it
+class Pipeline:
+	def __init__(self, stages):
+		self.stages = stages
+		self.results = []
+		self.wall_time = 0
+
+	def _worker(self, index, remaining):
+		stage = self.stages[index]
+		next_queue = self.stages[index+1].queue if index+1 < len(self.stages) else None
+
+		try:
+			while True:
+				entry = stage.queue.get()
+				if entry is DONE:
+					break
+				item, queued_at = entry
+
+				start = time.perf_counter()
+				try:
+					result = stage.func(item)
+				except Exception as e: # a failed item is recorded and dropped, the rest keep flowing
+					print('{} failed for {}: {}'.format(stage.name, item, e))
+					with stage.lock:
+						stage.errors[item] = e
+					result = None
+				end = time.perf_counter()
+
+				with stage.lock:
+					stage.timings.append((item, start - queued_at, end - start))
+				if result is not None:
+					if next_queue:
+						next_queue.put((result, end))
+					else:
+						with stage.lock:
+							self.results.append(result)
+		finally: # last worker out of a stage passes the end marker on to every worker of the next stage
+			with stage.lock:
+				remaining[index] -= 1
+				last = remaining[index] == 0
+			if last and next_queue:
+				for _ in range(self.stages[index+1].workers):
+					next_queue.put(DONE)
+
+	# feed items into the first stage and block until everything has drained; returns the output of the last stage
+	def run(self, items):
+		start = time.perf_counter()
+		remaining = [ stage.workers for stage in self.stages ]
+		threads = [ threading.Thread(target=self._worker, args=(i, remaining), daemon=True) for i, stage in enumerate(self.stages) for _ in range(stage.workers) ]
+		for thread in threads:
+			thread.start()
+
+		for item in items:
+			self.stages[0].queue.put((item, time.perf_counter()))
+		for _ in range(self.stages[0].workers):
+			self.stages[0].queue.put(DONE)
+
+		for thread in threads:
+			thread.join()
+		self.wall_time = time.perf_counter() - start
+		return self.results
+
+	def errors(self):
+		return { stage.name: dict(stage.errors) for stage in self.stages if stage.errors }
+
+	# per-stage item count, busy time (summed over workers), longest item and time items spent queued
+	def report(self):
+		lines = [ '{: <12} {:>6} {:>10} {:>10} {:>10}'.format('stage', 'items', 'busy (s)', 'max (s)', 'queued (s)') ]
+		for stage in self.stages:
+			run_times = [ t[2] for t in stage.timings ]
+			lines.append('{: <12} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}'.format(stage.name, len(stage.timings), sum(run_times), max(run_times, default=0), sum(t[1] for t in stage.timings)))
+		lines.append('wall time: {:.1f} s'.format(self.wall_time))
+		return '\n'.join(lines)
@@ -0,0 +1,64 @@
+import argparse
+import matplotlib
+import multiprocessing
+import numpy as np
+import os
+import resource
+import tempfile
+import time
+
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+
+from generic_plot import plot_csv
+
+
+# per-frame table like our concatenated motion/timecourse csvs: frame, value, run label (+ an unused column)
+def make_csv(path, rows, groups):
+	frames = rows // groups
+	with open(path, 'w') as f:
+		f.write('frame,value,run,other\n')
+		for g in range(groups):
+			frame = np.arange(frames)
+			value = np.cumsum(np.random.randn(frames)).round(4)
+			np.savetxt(f, np.c_[frame, value, np.full(frames, g), np.random.rand(frames)], delimiter=',', fmt=['%d', '%.4f', 'run%d', '%.6f'])
+
+
+# run one mode in its own process so peak RSS is not shared between modes
+def measure(data_file, kwargs, queue):
+	start = time.perf_counter()
+	plot_csv(data_file, 'frame', 'value', 'run', **kwargs)
+	plt.gcf().canvas.draw() # plt.show() in plot_csv does nothing on Agg, so the figure is drawn here: times reading, downsampling, plotting and drawing
+	queue.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)) # KB on linux
+
+
+def run(label, data_file, kwargs):
+	queue = multiprocessing.Queue()
+	proc = multiprocessing.Process(target=measure, args=(data_file, kwargs, queue))
+	proc.start()
+	elapsed, peak_rss = queue.get()
+	proc.join()
+	print('{: <10} {:8.1f} s  {:8.1f} MB peak RSS'.format(label, elapsed, peak_rss / 1e3))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='compare default and large-csv mode plot_csv on a generated csv')
+	parser.add_argument('--rows', type=int, default=5000000)
+	parser.add_argument('--groups', type=int, default=10)
+	parser.add_argument('--max_points', type=int, default=2000)
+	parser.add_argument('--chunksize', type=int, default=1000000)
+	parser.add_argument('--skip_default', action='store_true', help='only run the large-csv modes (default mode can take minutes on big files)')
+	args = parser.parse_args()
+
+	fd, data_file = tempfile.mkstemp(prefix='bench_plot_', suffix='.csv')
+	os.close(fd)
+	try:
+		make_csv(data_file, args.rows, args.groups)
+		print('{} rows, {} groups, {:.1f} MB'.format(args.rows, args.groups, os.path.getsize(data_file) / 1e6))
+
+		if not args.skip_default:
+			run('default', data_file, {})
+		run('compact', data_file, { 'max_points': args.max_points })
+		run('chunked', data_file, { 'max_points': args.max_points, 'chunksize': args.chunksize })
+	finally:
+		os.remove(data_file)
@@ -1,23 +1,86 @@
 import argparse
+import hashlib
+import json
+import os
 import pandas as pd
 import numpy as np
+import sqlite3
 
+from concurrent.futures import ProcessPoolExecutor
 from cycler import cycler
 from matplotlib import pyplot as plt
 
-def plot_csv(data_file, x_col, y_col, group_by=None, kind='line', subplots=(), grid=False, trailer=''):
-	print('sp', subplots)
-	if kind == 'line':
-		colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
-		plt.rc('axes', prop_cycle=(cycler('linestyle', ['-', ':']) * cycler('color', colors)))
+RENDER_CACHE = '.render_cache.sqlite' # next to the spec file; input hash + arguments of each rendered figure
+
+
+# indices of n_out points picked by largest-triangle-three-buckets, which keeps the visual shape (peaks, dips) of a line
+#   first and last points are always kept; each bucket in between keeps the point forming the largest triangle with
+#   the previously kept point and the average of the next bucket
+def lttb(x, y, n_out):
+	n = len(x)
+	if n_out >= n or n_out < 3:
+		return np.arange(n)
+
+	x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+	edges = np.linspace(1, n - 1, n_out - 1).astype(int) # n_out - 2 buckets between first and last point
+	indices = np.empty(n_out, dtype=np.int64)
+	indices[0], indices[-1] = 0, n - 1
+	a = 0
+	for i in range(n_out - 2):
+		start, end = edges[i], edges[i+1]
+		next_end = edges[i+2] if i + 2 < len(edges) else n
+		next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+		area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+		a = start + area.argmax()
+		indices[i+1] = a
+	return indices
+
 
-	df = pd.read_csv(data_file)
+# downsample each group's line to at most max_points (rows stay in file order)
+def downsample(df, x_col, y_col, group_by=None, max_points=2000):
+	groups = df.groupby(group_by, observed=True, sort=False) if group_by else [ (None, df) ]
+	parts = [ g_df.iloc[lttb(g_df[x_col].values, g_df[y_col].values, max_points)] for _, g_df in groups ]
+	return pd.concat(parts) if parts else df
+
+
+# read only the plotted columns, with explicit compact dtypes (float64 x, float32 y, categorical groups), so every chunk
+#   is parsed the same way; x must be numeric in this mode (it is downsampled as a number, see lttb)
+#   with chunksize, the file is read that many rows at a time and (if max_points is set) each chunk is downsampled
+#   as it is read, so memory stays bounded by the chunk size; the result is downsampled to max_points per group
+def read_columns(data_file, x_col, y_col, group_by=None, chunksize=None, max_points=None):
+	usecols = [ x_col, y_col ] + ([ group_by ] if group_by else [])
+	dtype = { x_col: 'float64', y_col: 'float32' } # float64 x keeps frame numbers / times exact
+	if group_by:
+		dtype[group_by] = 'category'
+
+	if chunksize:
+		chunks = [ downsample(chunk, x_col, y_col, group_by, max_points) if max_points else chunk for chunk in pd.read_csv(data_file, usecols=usecols, dtype=dtype, chunksize=chunksize) ]
+		df = pd.concat(chunks, ignore_index=True)
+		if group_by: # categories differ between chunks
+			df[group_by] = df[group_by].astype('category')
+	else:
+		df = pd.read_csv(data_file, usecols=usecols, dtype=dtype)
+	return downsample(df, x_col, y_col, group_by, max_points) if max_points else df
+
+
+# max_points / chunksize switch to large-csv mode (see read_columns); only line plots are downsampled
+# if outfile is set, the figure is saved there instead of shown
+def plot_csv(data_file, x_col, y_col, group_by=None, kind='line', subplots=(), grid=False, trailer='', max_points=None, chunksize=None, outfile=None):
+	print('sp', subplots)
+	if max_points or chunksize:
+		df = read_columns(data_file, x_col, y_col, group_by, chunksize, max_points if kind == 'line' else None)
+	else:
+		df = pd.read_csv(data_file)
 	
 	xlims = (df[x_col].min(), df[x_col].max())
 	ylims = (df[y_col].min()-5, df[y_col].max()+5)
 
 	nrows, ncols = subplots if subplots else (1,1)
 	fig, axes = plt.subplots(nrows, ncols, figsize=(nrows*4,ncols*4), sharex=True, sharey=True)
+	if kind == 'line': # set per axes from the default colors, so repeated calls in one process (e.g. batch workers) draw the same styles
+		colors = plt.rcParamsDefault['axes.prop_cycle'].by_key()['color']
+		for ax in np.atleast_1d(axes).flatten():
+			ax.set_prop_cycle(cycler('linestyle', ['-', ':']) * cycler('color', colors))
 
 	if not group_by:
 		df.plot(x_col, y_col, ax=axes, kind=kind)
@@ -43,20 +106,115 @@ def plot_csv(data_file, x_col, y_col, group_by=None, kind='line', subplots=(), g
 			plt.subplots_adjust(right=0.75)
 
 	
-	plt.show()
-	
+	if outfile:
+		fig.savefig(outfile, bbox_inches='tight')
+		plt.close(fig)
+	else:
+		plt.show()
+
+
+# <data_file name>_<y_col>[_<trailer>].png, in outdir (default next to the data file)
+def output_file(data_file, y_col, trailer='', outdir=None):
+	name = '{}_{}{}.png'.format(os.path.splitext(os.path.basename(data_file))[0], y_col, '_' + trailer if trailer else '')
+	return os.path.join(outdir if outdir else os.path.dirname(data_file), name)
+
+
+def file_hash(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+class RenderCache:
+	def __init__(self, cache_file):
+		self.conn = sqlite3.connect(cache_file)
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS renders (outfile TEXT PRIMARY KEY, key TEXT)')
+
+	def is_current(self, outfile, key):
+		row = self.conn.execute('SELECT key FROM renders WHERE outfile = ?', (outfile,)).fetchone()
+		return bool(row) and row[0] == key and os.path.exists(outfile)
+
+	def record(self, outfile, key):
+		with self.conn:
+			self.conn.execute('INSERT OR REPLACE INTO renders VALUES (?, ?)', (outfile, key))
+
+
+# worker for batch_plot: returns (outfile, error or None)
+def render_plot(plot):
+	plt.switch_backend('Agg') # no display in batch mode
+	try:
+		plot_csv(**plot)
+	except Exception as e: # e.g. a bad spec key (TypeError); one bad plot must not stop the rest of the batch
+		plt.close('all')
+		return plot['outfile'], e
+	return plot['outfile'], None
+
+
+# render every plot in a json spec to file, jobs at a time; the spec is a list of plot_csv arguments, or { 'defaults': {...}, 'plots': [...] }
+#   (relative data_file / outdir are relative to the spec); each plot is saved as output_file(...) and is skipped if its
+#   input file hash and arguments match its last render (unless force is set)
+def batch_plot(spec_file, jobs=None, force=False):
+	with open(spec_file) as f:
+		spec = json.load(f)
+	defaults, plots = (spec.get('defaults', {}), spec['plots']) if isinstance(spec, dict) else ({}, spec)
+
+	spec_dir = os.path.dirname(os.path.abspath(spec_file))
+	cache = RenderCache(os.path.join(spec_dir, RENDER_CACHE))
+	hashes, todo = {}, {}
+	for plot in plots:
+		plot = dict(defaults, **plot)
+		plot['data_file'] = os.path.join(spec_dir, plot['data_file'])
+		outdir = os.path.join(spec_dir, plot.pop('outdir')) if plot.get('outdir') else None
+		if outdir:
+			os.makedirs(outdir, exist_ok=True)
+		plot['outfile'] = output_file(plot['data_file'], plot['y_col'], plot.get('trailer'), outdir)
+		if 'subplots' in plot and plot['subplots']:
+			plot['subplots'] = tuple(plot['subplots'])
+
+		if plot['data_file'] not in hashes:
+			hashes[plot['data_file']] = file_hash(plot['data_file']) if os.path.exists(plot['data_file']) else None
+		key = hashlib.sha1(json.dumps([ hashes[plot['data_file']], plot ], sort_keys=True).encode()).hexdigest()
+		if force or not cache.is_current(plot['outfile'], key):
+			todo[plot['outfile']] = (plot, key)
+
+	print('{} of {} plots to render'.format(len(todo), len(plots)))
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		results = list(executor.map(render_plot, [ plot for plot, _ in todo.values() ]))
+
+	for outfile, error in results:
+		if error:
+			print('Could not render {}: {}'.format(outfile, error))
+		else:
+			cache.record(outfile, todo[outfile][1])
+	return results
+
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
-	parser.add_argument('data_file', help='csv file containing data to plot')
-	parser.add_argument('x_col', help='column to plot on x-axis')
-	parser.add_argument('y_col', help='column to plot on y-axis')
+	parser.add_argument('data_file', nargs='?', help='csv file containing data to plot')
+	parser.add_argument('x_col', nargs='?', help='column to plot on x-axis')
+	parser.add_argument('y_col', nargs='?', help='column to plot on y-axis')
 	parser.add_argument('-g', '--group_by', help='column used to split data into separate datasets (default is all data in one set)')
 	parser.add_argument('--grid', action='store_true', help='show grid lines')
 	parser.add_argument('-k', '--kind', default='line', choices=['line','bar','barh','hist','box','kde','area','pie','scatter','hexbin', 'violin'], help='type of graph (defaut=line)')
 	parser.add_argument('-s', '--subplots', type=int, nargs=2, help='how to split groups into different graphs (i.e. 3 2 would give 3 rows by 2 cols; default is all on same graph)')
 	parser.add_argument('-t', '--trailer', help='trailer for output file name(s)')
+	parser.add_argument('--max_points', type=int, help='large csv mode: downsample each line to this many points (LTTB)')
+	parser.add_argument('--chunksize', type=int, help='large csv mode: read the csv this many rows at a time')
+	parser.add_argument('--save', action='store_true', help='save the figure (as <data_file name>_<y_col>[_<trailer>].png) instead of showing it')
+	parser.add_argument('--spec', help='batch mode: json file listing plots to render to file (see batch_plot)')
+	parser.add_argument('-j', '--jobs', type=int, help='batch mode: number of plots to render concurrently (default = number of cores)')
+	parser.add_argument('--force', action='store_true', help='batch mode: re-render plots even if unchanged since the last render')
 	args = parser.parse_args()
 
-	plot_csv(args.data_file, args.x_col, args.y_col, args.group_by, args.kind, tuple(args.subplots) if args.subplots else None, args.grid, args.trailer)
+	if args.spec:
+		batch_plot(args.spec, args.jobs, args.force)
+	elif not args.y_col:
+		parser.error('data_file, x_col and y_col are required without --spec')
+	else:
+		outfile = output_file(args.data_file, args.y_col, args.trailer) if args.save else None
+		plot_csv(args.data_file, args.x_col, args.y_col, args.group_by, args.kind, tuple(args.subplots) if args.subplots else None, args.grid, args.trailer, args.max_points, args.chunksize, outfile)
@@ -1,45 +1,119 @@
 import argparse
+import csv
+import matplotlib
 import numpy as np
-from scipy import stats
 
+from concurrent.futures import ProcessPoolExecutor
+
+matplotlib.use('Agg') # figures are only saved, so no display is needed (and batch workers can render in parallel)
 from matplotlib import pyplot
 
+UNDEFINED = 500 # value written for frames with no FD/dvars (e.g. first frame of a run)
+SUMMARY_FIELDS = ['file', 'run', 'frames', 'undefined', 'thresh', 'censored', 'pct_kept', 'mean', 'median', 'max']
+
+
+# first (tab-separated) column of an FD/dvars file
+def load_values(value_file):
+	return np.loadtxt(value_file, delimiter='\t', usecols=0, ndmin=1)
 
+
+# dvars criterion: mode + 2.5 sd; values are continuous, so the mode is taken as the center of the fullest histogram bin
 def find_dvar_crit(dvars):
-	mode = stats.mode(dvars)[0]
+	dvars = dvars[dvars != UNDEFINED]
+	counts, edges = np.histogram(dvars, bins='auto')
+	peak = counts.argmax()
+	mode = (edges[peak] + edges[peak+1]) / 2
 	sd = np.std(dvars)
 	return mode + (2.5 * sd)
 
 
+# runs are assumed to be the same length (leftover frames go to the first runs)
+def split_runs(vals, num_runs=None):
+	return np.array_split(vals, num_runs) if num_runs else [ vals ]
+
+
+# frames kept after censoring (defined and not above thresh) and summary stats for one run
+def run_stats(vals, thresh=None, dvars=False):
+	defined = vals != UNDEFINED
+	if dvars and not thresh:
+		thresh = find_dvar_crit(vals)
+	keep = defined & (vals <= thresh) if thresh else defined
+	defined_vals = vals[defined]
+	return keep, {
+		'frames': len(vals),
+		'undefined': int((~defined).sum()),
+		'thresh': thresh,
+		'censored': int((defined & ~keep).sum()),
+		'pct_kept': 100 * keep.sum() / len(vals) if len(vals) else 0,
+		'mean': defined_vals.mean() if defined_vals.size else np.nan,
+		'median': np.median(defined_vals) if defined_vals.size else np.nan,
+		'max': defined_vals.max() if defined_vals.size else np.nan
+	}
+
+
+def render(vals, thresh, outfile):
+	fig, ax = pyplot.subplots()
+	ax.plot(np.where(vals != UNDEFINED, vals, np.nan))
+	if thresh:
+		ax.axhline(thresh, color='C1')
+	fig.savefig(outfile)
+	pyplot.close(fig)
+
+
 def plot_values(value_file, thresh=None, dvars=False, run=None, num_runs=None):
-	vals = [ float(line.split('\t')[0]) for line in open(value_file).readlines() ]
+	vals = load_values(value_file)
 
 	if run and num_runs:
-		num_frames = len(vals) / num_runs
-		start = (run - 1) * num_frames 
-		vals = vals[start:start+num_frames]
-
-	pyplot.plot([ val if val != 500 else np.nan for val in vals])
+		vals = split_runs(vals, num_runs)[run - 1]
 
 	if dvars and not thresh:
 		thresh = find_dvar_crit(vals)
-	if thresh:
-		pyplot.plot([ thresh for x in range(len(vals)) ])
 
-	pyplot.savefig(value_file + '.png')
+	render(vals, thresh, value_file + '.png')
+
+
+# stats for every run of one file (one row per run), optionally saving a plot per run as <value_file>[.run<N>].png
+def qc_file(value_file, thresh=None, dvars=False, num_runs=None, plot=True):
+	rows = []
+	for i, vals in enumerate(split_runs(load_values(value_file), num_runs), start=1):
+		_, stats = run_stats(vals, thresh, dvars)
+		rows.append(dict(stats, file=value_file, run=i))
+		if plot:
+			render(vals, stats['thresh'], '{}{}.png'.format(value_file, '.run{}'.format(i) if num_runs else ''))
+	return rows
+
+
+# qc all files in a process pool and write one study-level table (one row per file and run)
+def batch_qc(value_files, summary_file, thresh=None, dvars=False, num_runs=None, plot=True, jobs=None):
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		futures = [ executor.submit(qc_file, value_file, thresh, dvars, num_runs, plot) for value_file in value_files ]
+		rows = []
+		for value_file, future in zip(value_files, futures):
+			try:
+				rows += future.result()
+			except (OSError, ValueError) as e: # unreadable file: report and keep going
+				print('Could not process {}: {}'.format(value_file, e))
+
+	with open(summary_file, 'w') as f:
+		writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+		writer.writeheader()
+		writer.writerows(rows)
+	return rows
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
-	parser.add_argument('input_file', help='FD or dvars values file')
+	parser.add_argument('input_files', nargs='+', help='FD or dvars values file(s)')
 	parser.add_argument('--thresh', type=float, help='specify the movement threshold')
 	parser.add_argument('--dvars', action='store_true')
 	parser.add_argument('--run', type=int, help='which run to plot (defualt is all runs in file)')
 	parser.add_argument('--num_runs', type=int, help='how many runs are in file')
+	parser.add_argument('-s', '--summary', help='batch mode: write per-run censoring stats for all input files to this csv (implied for multiple files, default fd_summary.csv)')
+	parser.add_argument('--no_plot', action='store_true', help='batch mode: only write the summary table')
+	parser.add_argument('-j', '--jobs', type=int, help='batch mode: number of files to process concurrently (default = number of cores)')
 	args = parser.parse_args()
 
-	plot_values(args.input_file, args.thresh, args.dvars, args.run, args.num_runs)
-	 
-
-
-
+	if args.summary or len(args.input_files) > 1:
+		batch_qc(args.input_files, args.summary if args.summary else 'fd_summary.csv', args.thresh, args.dvars, args.num_runs, not args.no_plot, args.jobs)
+	else:
+		plot_values(args.input_files[0], args.thresh, args.dvars, args.run, args.num_runs)
@@ -1,44 +1,111 @@
 import argparse
 import glob
 import json
+import multiprocessing
 import os
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import call
 from sys import exit, stderr
 
 # local files
-from download_dicoms import download_dicoms
-from params_setup import gen_params_file
+from cnda_common import cache_stats, enable_cache, CACHE_FILE
+from dicom_index import get_index
+from download_dicoms import download_session, get_auth_session, plan_downloads
+from fs_queue import submit as submit_fs_jobs
+from params_setup import default_day1_patid, gen_session_params, SeriesMatcher
+from pipeline import Pipeline, Stage
+from study_index import get_study_index
+from study_state import file_hash, fingerprint, StudyState
 
 scripts_dir = '/net/zfs-black/BLACK/black/git/utils'
 
-def setup(config_file, img_type=None, sessions=[]):
+# sessions flow through download -> sort/params -> FreeSurfer submission (to the fs_queue runner), each moving on as soon as its previous stage is done
+#   (jobs downloads and params_jobs params workers at a time); stage timing is printed at the end
+def setup(config_file, img_type=None, sessions=[], jobs=1, sync=False, params_jobs=None):
 	with open(config_file) as f:
 		config = json.load(f)
 
-	existing_patids = [ d.split('_')[0] for d in os.listdir('.') if os.path.isdir(d) ]
-
 	series_mapping = config['series_desc_mapping']
 	t1_series_desc = '|'.join([ k for k,v in series_mapping.items() if v == 'mprs' ])
 
 	scan_types = list(series_mapping.keys())
+	keep_all = list(config['irun'].keys()) # irun (functional) series are never filtered as duplicates, same as gen_params_file
+	project_id = config['cnda_project_id']
+
+	sess = get_auth_session(jobs)
+	subject_session_map, manifest, session_ids = plan_downloads(sess, project_id, exclusions=config['exclusions'], sync=sync, duplicates=img_type)
+	to_download = { session: subject for subject, session in subject_session_map }
+
+	# completed stages are checkpointed with fingerprints of their inputs, so re-runs only redo what changed
+	state = StudyState()
+	config_hash = fingerprint(config)
+
+	def download(session):
+		if session not in to_download: # already on disk (passed in with -s or processed before)
+			return session
+		extracted = download_session(sess, project_id, to_download[session], session, scan_types, manifest=manifest, session_id=session_ids.get(session), duplicates=img_type, keep_all=keep_all)
+		if extracted is None:
+			raise RuntimeError('download failed') # recorded as a download error
+		if extracted: # [] = already up to date (with --sync)
+			state.record(session, 'download')
+		return session
+
+	study_config = os.path.abspath(config_file)
+	matcher = SeriesMatcher(config)
+	get_study_index(os.path.dirname(study_config)) # bring the study index up to date once, before params workers look up day1 atlases in it
+	# gen_params_file runs from inside the session dir, so it needs its own process
+	#   workers come from a forkserver, not a fork of this (already threaded) process, so they cannot inherit a lock held by another thread (e.g. the dicom header cache's)
+	params_executor = ProcessPoolExecutor(max_workers=params_jobs, mp_context=multiprocessing.get_context('forkserver'))
 
-	new_sessions = download_dicoms(config['cnda_project_id'], scan_types=scan_types, exclusions=config['exclusions'])
-	sessions += new_sessions
-	for session in sessions:
-		patid = session.split('_')[0]
-		day1_patid = '{}_s1'.format(patid) if not session.endswith('s1') else None
-		dicom_dir = [ d for d in os.listdir(session) ][0] # dicom_dir should be only thing in patient directory after download
-		gen_params_file(session, '*', config_file, sort=True, duplicates=img_type, day1_patid=day1_patid)
+	def gen_params(session):
+		day1_patid = default_day1_patid(session)
+		params_file = os.path.join(session, session + '.params')
+		inputs = fingerprint(config_hash, get_index(os.path.abspath(session)).fingerprint(), img_type, day1_patid)
 
-		fs_config = config['freesurfer']
-		if fs_config['subjects_dir'] and not day1_patid and not os.path.exists(os.path.join(fs_config['subjects_dir'], session)):
+		if state.is_current(session, 'params', inputs) and os.path.exists(params_file):
+			print('Params up to date:', session)
+		elif state.output_modified(session, 'params', params_file): # never overwrite hand edits
+			print('Warning: {} was modified outside study_setup, not regenerating it (remove it to regenerate)'.format(params_file))
+		else:
+			_, error = params_executor.submit(gen_session_params, os.path.abspath(session), study_config, config, matcher, img_type, day1_patid).result()
+			if error:
+				raise RuntimeError(error)
+			state.record(session, 'params', inputs, params_file)
+		return None if day1_patid else session # only first sessions get their own FreeSurfer run
+
+	fs_config = config['freesurfer']
+	fs_index = get_study_index(fs_config['subjects_dir']) if fs_config['subjects_dir'] else None
+
+	def launch_freesurfer(session):
+		inputs = fingerprint(file_hash(os.path.join(session, session + '.params')), fs_config)
+		if not fs_index or state.is_current(session, 'freesurfer', inputs):
+			return None
+		if not fs_index.fs_subject(session):
 			cmd = [os.path.join(scripts_dir, 'gen_fs_calls.csh'), session, "{}".format(t1_series_desc), fs_config['subjects_dir'], fs_config['recon-all_flags']]
 			print(' '.join(cmd))
 			print(os.getcwd())
 			call(cmd)
-			call(['at', 'now', '-f', '{0}/{0}_fs_call.csh'.format(session)])
+			submit_fs_jobs(['{0}/{0}_fs_call.csh'.format(session)], max_jobs=fs_config.get('max_jobs')) # local queue limits concurrent recon-all runs by cores/memory
+		state.record(session, 'freesurfer', inputs)
+		return session
 
+	pipeline = Pipeline([
+		Stage('download', download, jobs),
+		Stage('params', gen_params, params_jobs if params_jobs else os.cpu_count()),
+		Stage('freesurfer', launch_freesurfer)
+	])
+	try:
+		known_sessions = [ session for session in state.sessions() if os.path.isdir(session) ] # re-checked so config/data changes are picked up
+		pipeline.run(list(dict.fromkeys(sessions + list(to_download.keys()) + known_sessions)))
+	finally:
+		params_executor.shutdown()
+
+	for stage, errors in pipeline.errors().items():
+		print('{} failed for: {}'.format(stage, ' '.join(errors.keys())))
+	print(pipeline.report())
+	print(cache_stats())
+	print(sess.metrics.report())
 	return
 
 
@@ -47,6 +114,13 @@ if __name__ == '__main__':
 	parser.add_argument('study_config', help='json file containing study-specific parameters')
 	parser.add_argument('-d', '--duplicates', metavar='img_type', choices=['orig', 'norm'], help='if you have duplicate scans, which Image Type to use (if unspecified, all will be used)')
 	parser.add_argument('-s', '--sessions', nargs='+', default=[], help='list of sessions to process')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='number of sessions to download concurrently (default is 1)')
+	parser.add_argument('--params_jobs', type=int, help='number of sessions to sort / generate params for concurrently (default = number of cores)')
+	parser.add_argument('--sync', action='store_true', help='top up already downloaded sessions with any new scans (tracked in <cnda_project_id>_manifest.json)')
+	parser.add_argument('--cache', nargs='?', const=CACHE_FILE, help='cache CNDA metadata in sqlite file (default {}) so repeat runs only query new/changed sessions'.format(CACHE_FILE))
 	args = parser.parse_args()
 
-	setup(args.study_config, args.duplicates, args.sessions)
+	if args.cache:
+		enable_cache(args.cache)
+
+	setup(args.study_config, args.duplicates, args.sessions, args.jobs, args.sync, args.params_jobs)
@@ -0,0 +1,51 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_FILE = '.study_state.sqlite'
+
+
+# stable hash of any json-serializable inputs (e.g. the study config, a dicom manifest hash, command line options)
+def fingerprint(*parts):
+	return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_hash(path):
+	if not os.path.exists(path):
+		return None
+	with open(path, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+
+# per-study record of which stages each session has completed, with the fingerprint of the stage's inputs and a hash of its output file
+#   stored in <study_dir>/.study_state.sqlite; a stage only needs re-running if its inputs changed since it was recorded
+class StudyState:
+	def __init__(self, study_dir='.'):
+		self.lock = threading.Lock() # shared by the study_setup stage threads
+		self.conn = sqlite3.connect(os.path.join(study_dir, STATE_FILE), check_same_thread=False)
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS stages (session TEXT, stage TEXT, fingerprint TEXT, output_hash TEXT, completed REAL, PRIMARY KEY (session, stage))')
+
+	# True if the stage was recorded with these inputs (outputs are not compared, see output_modified)
+	def is_current(self, session, stage, inputs_fingerprint):
+		with self.lock:
+			row = self.conn.execute('SELECT fingerprint FROM stages WHERE session = ? AND stage = ?', (session, stage)).fetchone()
+		return bool(row) and row[0] == inputs_fingerprint
+
+	# True if the stage's output file exists but is not what the stage wrote (e.g. edited by hand since)
+	def output_modified(self, session, stage, output):
+		with self.lock:
+			row = self.conn.execute('SELECT output_hash FROM stages WHERE session = ? AND stage = ?', (session, stage)).fetchone()
+		current = file_hash(output)
+		return bool(row) and row[0] is not None and current is not None and current != row[0]
+
+	def record(self, session, stage, inputs_fingerprint=None, output=None):
+		with self.lock, self.conn:
+			self.conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)', (session, stage, inputs_fingerprint, file_hash(output) if output else None, time.time()))
+
+	def sessions(self):
+		with self.lock:
+			return [ session for session, in self.conn.execute('SELECT DISTINCT session FROM stages ORDER BY session') ]